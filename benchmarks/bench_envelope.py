@@ -0,0 +1,64 @@
+"""
+    discord-bot-2 backend
+
+    Benchmark of the binary job envelope against the previous JSON-of-hex encoding
+
+    Run with: python -m benchmarks.bench_envelope
+
+"""
+import json
+import secrets
+import timeit
+from hashlib import md5
+
+from bot_worker.envelope import Envelope, pack, unpack
+
+ROUNDS = 100_000
+
+
+def legacy_pack(job_id: str, frames: list[bytes]) -> str:
+    return json.dumps([job_id, *[x.hex() for x in frames]])
+
+
+def legacy_unpack(data: str) -> tuple[str, list[bytes]]:
+    job = json.loads(data)
+    return job[0], [bytes.fromhex(x) for x in job[1:]]
+
+
+def main() -> None:
+    job_id = md5(secrets.token_bytes(8)).hexdigest()
+    identity = secrets.token_bytes(5)
+    payloads = {
+        "small": json.dumps({"command": "dnd_dice_roll", "params": {"rolls": ["4d12"]}}),
+        "large": json.dumps({"command": "say_test", "params": {"text": "words " * 300}}),
+    }
+
+    print(f"{'payload':<8}{'format':<10}{'bytes':>8}{'pack us':>10}{'unpack us':>11}")
+    for name, payload in payloads.items():
+        frames = [identity, b"", payload.encode()]
+        legacy = legacy_pack(job_id, frames)
+        binary = pack(Envelope(job_id, frames))
+        assert legacy_unpack(legacy) == (job_id, frames)
+        assert unpack(binary) == Envelope(job_id, frames)
+
+        results = {
+            "json-hex": (
+                len(legacy.encode()),
+                timeit.timeit(lambda: legacy_pack(job_id, frames), number=ROUNDS),
+                timeit.timeit(lambda: legacy_unpack(legacy), number=ROUNDS),
+            ),
+            "binary": (
+                len(binary),
+                timeit.timeit(lambda: pack(Envelope(job_id, frames)), number=ROUNDS),
+                timeit.timeit(lambda: unpack(binary), number=ROUNDS),
+            ),
+        }
+        for fmt, (size, pack_s, unpack_s) in results.items():
+            print(
+                f"{name:<8}{fmt:<10}{size:>8}"
+                f"{pack_s / ROUNDS * 1e6:>10.2f}{unpack_s / ROUNDS * 1e6:>11.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
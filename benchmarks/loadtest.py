@@ -0,0 +1,417 @@
+"""
+    discord-bot-2 backend
+
+    Load test of the router/worker pipeline. Drives a real Router over ZMQ DEALER sockets with
+    Poisson arrivals of a configurable request mix, with in-process workers behind it and
+    Google TTS and Reddit replaced by stubs of configurable latency. Runs against an in-memory
+    Redis stand-in or the Redis server in the test config. Reports throughput and p50/p99
+    latency for each combination of num_workers and message size
+
+    Run with: TESTING=1 python -m benchmarks.loadtest --workers 1,2,4 --sizes 64,1024,8192
+    Compare to a previous run with: --output new.json --baseline old.json
+
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import zmq
+import zmq.asyncio
+from google.cloud import texttospeech
+
+from bot_worker import reddit
+from bot_worker.config import CONFIG
+from bot_worker.db import create_redis
+from bot_worker.google_handler import GoogleHandler
+from bot_worker.lanes import LANE_WEIGHTS, lane_queue
+from bot_worker.reddit import MemePool
+from bot_worker.router import Router
+from bot_worker.worker import Worker
+
+
+class MemoryRedis:
+    """
+    Just enough of the async Redis client for the list transport, router and workers,
+    held in memory with blocking pops woken on every push
+    """
+
+    def __init__(self) -> None:
+        self.lists: dict[str, deque[bytes]] = defaultdict(deque)
+        self.pushed = asyncio.Condition()
+
+    def pipeline(self) -> "MemoryPipeline":
+        return MemoryPipeline(self)
+
+    async def rpush(self, key: str, *values: bytes) -> int:
+        async with self.pushed:
+            self.lists[key].extend(values)
+            self.pushed.notify_all()
+        return len(self.lists[key])
+
+    async def blpop(self, keys: list[str], timeout: int = 0) -> tuple[bytes, bytes] | None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        async with self.pushed:
+            while True:
+                for key in keys:
+                    if self.lists[key]:
+                        return key.encode(), self.lists[key].popleft()
+                remaining = deadline - loop.time()
+                if timeout and remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(self.pushed.wait(), remaining if timeout else None)
+                except asyncio.TimeoutError:
+                    return None
+
+    async def llen(self, key: str) -> int:
+        return len(self.lists[key])
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self.lists.pop(key, None) is not None for key in keys)
+
+
+class MemoryPipeline:
+    def __init__(self, db: MemoryRedis) -> None:
+        self.db = db
+        self.calls: list = []
+
+    def __getattr__(self, name: str):
+        def queue(*args, **kwargs) -> "MemoryPipeline":
+            self.calls.append((getattr(self.db, name), args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self) -> list:
+        return [await func(*args, **kwargs) for func, args, kwargs in self.calls]
+
+
+class StubTTSClient:
+    """
+    Stands in for the synchronous TextToSpeechClient, blocking its executor thread
+    for the configured latency and returning roughly MP3-sized audio
+    """
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    def synthesize_speech(self, input, audio_config, voice) -> SimpleNamespace:
+        time.sleep(self.latency)
+        return SimpleNamespace(audio_content=bytes(len(input.text) * 64))
+
+
+def install_stubs(args: argparse.Namespace, output_dir: str) -> None:
+    settings = GoogleHandler.VOICE_PRESETS["default"]
+    GoogleHandler.voice = texttospeech.VoiceSelectionParams(
+        language_code=settings["language"][:5], name=settings["name"]
+    )
+    GoogleHandler.audio_config = texttospeech.AudioConfig(
+        audio_encoding=texttospeech.AudioEncoding.MP3,
+        pitch=settings["pitch"],
+        speaking_rate=settings["rate"],
+    )
+    GoogleHandler.client = StubTTSClient(args.tts_latency_ms / 1000)
+    GoogleHandler.executor = ThreadPoolExecutor(
+        max_workers=CONFIG.getint("texttospeech", "synthesis_concurrency"),
+        thread_name_prefix="tts",
+    )
+    GoogleHandler.output_dir = output_dir
+    GoogleHandler.cache = None
+
+    async def set_auth(refresh: bool = False) -> None:
+        pass
+
+    async def scrape_subreddit(subreddit: str, time: str = "week", lim: int = 10, **_) -> list:
+        await asyncio.sleep(args.reddit_latency_ms / 1000)
+        return [
+            {
+                "id": f"{subreddit}-{i}",
+                "title": "Stub meme",
+                "url": f"https://i.redd.it/{subreddit}-{i}.png",
+                "author": "stub",
+                "subreddit": f"r/{subreddit}",
+                "score": random.randint(1, 10000),
+                "upvote_ratio": "95%",
+            }
+            for i in range(lim)
+        ]
+
+    reddit.set_auth = set_auth
+    reddit.scrape_subreddit = scrape_subreddit
+
+
+def make_request(command: str, size: int) -> bytes:
+    """
+    A request for the command, with say_test text of `size` characters. The text is unique
+    so results are never served from the command cache
+    """
+    if command == "say_test":
+        text = f"{secrets.token_hex(4)} " + "Hello there. " * (size // 13 + 1)
+        params = {"text": text[:size]}
+    elif command == "dnd_dice_roll":
+        params = {"rolls": ["4d12", "2d20"]}
+    else:
+        params = {}
+    return json.dumps({"command": command, "params": params}).encode()
+
+
+class ClientPool:
+    """
+    DEALER sockets with at most one request outstanding each, so responses match requests
+    """
+
+    def __init__(self, address: str) -> None:
+        self.ctx = zmq.asyncio.Context()
+        self.address = address
+        self.idle: list[zmq.asyncio.Socket] = []
+
+    async def request(self, payload: bytes, timeout: float) -> tuple[float, str]:
+        """
+        Send a request and wait for its final response, returning the latency in ms
+        and an error message, empty on success
+        """
+        if self.idle:
+            sock = self.idle.pop()
+        else:
+            sock = self.ctx.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(self.address)
+
+        start = time.perf_counter()
+        await sock.send_multipart([payload])
+        deadline = start + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or not await sock.poll(remaining * 1000):
+                # a late response would be read by the next request, so drop the socket
+                sock.close()
+                return (time.perf_counter() - start) * 1000, "client timeout"
+            response = json.loads((await sock.recv_multipart())[-1])
+            if not response.get("partial"):
+                break
+
+        latency = (time.perf_counter() - start) * 1000
+        self.idle.append(sock)
+        if response["code"] != 0:
+            return latency, response["error"]["msg"]
+        return latency, ""
+
+    def close(self) -> None:
+        self.ctx.destroy(linger=0)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def summarise(latencies: list[float]) -> dict:
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+    }
+
+
+async def run_scenario(
+    args: argparse.Namespace, mix: dict[str, float], num_workers: int, size: int, port: int
+) -> dict:
+    """
+    Start a router and workers, offer load for the test duration, then wait for every response
+    """
+    address = f"tcp://127.0.0.1:{port}"
+    CONFIG.set("startup", "zmq_address", address)
+    CONFIG.set("startup", "num_workers", str(num_workers))
+    db = MemoryRedis() if args.redis == "memory" else create_redis()
+    await db.delete(*[lane_queue("job_queue", lane) for lane in LANE_WEIGHTS])
+
+    router = Router(db)
+    workers = [Worker(f"load.{i}", db) for i in range(num_workers)]
+    tasks = [
+        asyncio.create_task(coro)
+        for coro in (
+            router.recv(),
+            router.send(),
+            router.monitor_queues(),
+            router.expire_jobs(),
+            MemePool.run(),
+            *[worker.run() for worker in workers],
+        )
+    ]
+
+    clients = ClientPool(address)
+    commands, weights = list(mix), list(mix.values())
+    requests: list[tuple[str, asyncio.Task]] = []
+    start = time.perf_counter()
+    next_arrival = start
+    while next_arrival < start + args.duration:
+        await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+        command = random.choices(commands, weights)[0]
+        task = asyncio.create_task(clients.request(make_request(command, size), args.timeout))
+        requests.append((command, task))
+        next_arrival += random.expovariate(args.rate)
+    await asyncio.gather(*[task for _, task in requests])
+    elapsed = time.perf_counter() - start
+
+    router.is_shutting_down = True
+    for worker in workers:
+        worker.is_shutting_down = True
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    clients.close()
+
+    ok: list[float] = []
+    by_command: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    for command, task in requests:
+        latency, error = task.result()
+        if error:
+            errors[error] += 1
+        else:
+            ok.append(latency)
+            by_command[command].append(latency)
+
+    return {
+        "num_workers": num_workers,
+        "size": size,
+        "offered_rps": args.rate,
+        "sent": len(requests),
+        "completed": len(ok),
+        "errors": dict(errors),
+        "throughput_rps": round(len(ok) / elapsed, 2),
+        **summarise(ok),
+        "commands": {command: summarise(values) for command, values in by_command.items()},
+    }
+
+
+def compare(results: list[dict], baseline_path: str, max_regression: float) -> bool:
+    """
+    Print the change from the baseline for each scenario in both,
+    returning False if any regressed by more than max_regression
+    """
+    with open(baseline_path, "r") as file:
+        baseline = {(r["num_workers"], r["size"]): r for r in json.load(file)["results"]}
+
+    passed = True
+    print(f"\n{'workers':>8}{'size':>8}{'rps':>10}{'p50':>10}{'p99':>10}  vs baseline")
+    for result in results:
+        base = baseline.get((result["num_workers"], result["size"]))
+        if base is None:
+            continue
+        changes = {
+            key: (result[key] - base[key]) / base[key] if base[key] else 0.0
+            for key in ("throughput_rps", "p50_ms", "p99_ms")
+        }
+        regressed = (
+            changes["throughput_rps"] < -max_regression or changes["p99_ms"] > max_regression
+        )
+        passed = passed and not regressed
+        print(
+            f"{result['num_workers']:>8}{result['size']:>8}"
+            + "".join(f"{changes[key]:>+10.1%}" for key in changes)
+            + ("  REGRESSED" if regressed else "")
+        )
+    return passed
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1].strip())
+    parser.add_argument("--redis", choices=("memory", "local"), default="memory")
+    parser.add_argument("--workers", default="1,2,4", help="num_workers values to run")
+    parser.add_argument("--sizes", default="64,1024,8192", help="say_test text sizes to run")
+    parser.add_argument(
+        "--mix",
+        default="dnd_dice_roll=6,say_test=3,memeoftheday=1",
+        help="relative weights of commands",
+    )
+    parser.add_argument("--rate", type=float, default=200, help="offered requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load per run")
+    parser.add_argument("--timeout", type=float, default=30, help="client response timeout")
+    parser.add_argument("--tts-latency-ms", type=float, default=150)
+    parser.add_argument("--reddit-latency-ms", type=float, default=300)
+    parser.add_argument("--port", type=int, default=5600, help="first of one port per run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare to")
+    parser.add_argument("--max-regression", type=float, default=0.1)
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> bool:
+    logging.basicConfig(level=logging.ERROR)
+    random.seed(args.seed)
+    mix = {
+        command: float(weight)
+        for command, weight in (item.split("=") for item in args.mix.split(","))
+    }
+    worker_counts = [int(n) for n in args.workers.split(",")]
+    sizes = [int(n) for n in args.sizes.split(",")]
+    if args.redis == "memory":
+        CONFIG.set("queue", "transport", "list")
+    else:
+        # every worker holds a pooled connection in its blocking pop
+        CONFIG.set("redis", "max_connections", str(max(worker_counts) + 8))
+
+    results = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        install_stubs(args, output_dir)
+        print(f"{'workers':>8}{'size':>8}{'sent':>8}{'errors':>8}{'rps':>10}{'p50':>10}{'p99':>10}")
+        for num_workers in worker_counts:
+            for size in sizes:
+                port = args.port + len(results)
+                result = await run_scenario(args, mix, num_workers, size, port)
+                results.append(result)
+                print(
+                    f"{num_workers:>8}{size:>8}{result['sent']:>8}"
+                    f"{sum(result['errors'].values()):>8}{result['throughput_rps']:>10.1f}"
+                    f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}"
+                )
+
+    if args.output:
+        report = {
+            "meta": {
+                "commit": git_commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "args": vars(args),
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        return compare(results, args.baseline, args.max_regression)
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main(parse_args())) else 1)
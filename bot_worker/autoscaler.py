@@ -0,0 +1,188 @@
+"""
+    discord-bot-2 backend
+
+    Worker autoscaling from queue depth, queue wait and worker utilization
+
+"""
+import asyncio
+import json
+import logging
+import time
+from functools import partial
+from typing import Protocol
+
+from redis.asyncio import Redis
+from redis.exceptions import ConnectionError, RedisError
+
+from .config import CONFIG
+from .metrics import WORKER_COUNT, WORKER_UTILIZATION
+from .router import Router
+from .worker import Worker
+
+
+class WorkerPool(Protocol):
+    @property
+    def size(self) -> int:
+        ...
+
+    def add(self) -> None:
+        ...
+
+    def retire(self) -> None:
+        ...
+
+
+class CoroutinePool:
+    """
+    Worker coroutines in this process
+    """
+
+    def __init__(self, db: Redis, stats_scope: str) -> None:
+        self.db = db
+        self.stats_scope = stats_scope
+        self.workers: list[tuple[Worker, asyncio.Task]] = []
+        self.retiring: set[asyncio.Task] = set()
+        self.next_id = 0
+
+    @property
+    def size(self) -> int:
+        return len(self.workers)
+
+    def add(self) -> None:
+        worker = Worker(str(self.next_id), self.db, self.stats_scope)
+        self.next_id += 1
+        task = asyncio.create_task(worker.run())
+        task.add_done_callback(partial(self.finished, worker))
+        self.workers.append((worker, task))
+
+    def retire(self) -> None:
+        """
+        Stop the newest worker taking jobs, leaving it to finish the ones it has
+        """
+        worker, task = self.workers.pop()
+        worker.is_shutting_down = True
+        self.retiring.add(task)
+        task.add_done_callback(self.retiring.discard)
+        logging.info("[autoscaler] Retiring %s", worker.wid)
+
+    def finished(self, worker: Worker, task: asyncio.Task) -> None:
+        """
+        Drop a worker that has exited. One that wasn't retired has crashed and is replaced
+        straight away, keeping the pool at the size the autoscaler last set
+        """
+        WORKER_UTILIZATION.remove(worker.wid)
+        if (worker, task) not in self.workers:
+            return
+        self.workers.remove((worker, task))
+        if task.cancelled():
+            # Only when the loop is shutting down
+            return
+        logging.error("[autoscaler] %s exited, replacing it", worker.wid, exc_info=task.exception())
+        self.add()
+
+
+class Autoscaler:
+    """
+    Scales a pool of workers, or of worker processes, between the configured bounds.
+    The pool grows by one as soon as the job queue depth per worker, the queue wait or the
+    utilization reported by workers is over its threshold, and shrinks by one only once all
+    have been under their lower thresholds for several checks in a row. Each change is
+    followed by a cooldown, so the count doesn't flap
+    """
+
+    def __init__(self, router: Router, db: Redis, pool: WorkerPool, unit_capacity: int) -> None:
+        self.router = router
+        self.db = db
+        self.pool = pool
+        # Only this router's workers, as other routers and their workers may share Redis
+        self.stats_pattern = f"worker_stats:{router.router_id}:*"
+        self.unit_capacity = unit_capacity  # jobs at once per worker or process
+        self.min_size = CONFIG.getint("autoscaling", "min_workers")
+        self.max_size = CONFIG.getint("autoscaling", "max_workers")
+        self.check_interval = CONFIG.getfloat("autoscaling", "check_interval_s")
+        self.up_depth = CONFIG.getfloat("autoscaling", "scale_up_depth_per_worker")
+        self.up_wait_ms = CONFIG.getfloat("autoscaling", "scale_up_wait_ms")
+        self.up_utilization = CONFIG.getfloat("autoscaling", "scale_up_utilization")
+        self.up_cooldown = CONFIG.getfloat("autoscaling", "scale_up_cooldown_s")
+        self.down_depth = CONFIG.getfloat("autoscaling", "scale_down_depth")
+        self.down_wait_ms = CONFIG.getfloat("autoscaling", "scale_down_wait_ms")
+        self.down_utilization = CONFIG.getfloat("autoscaling", "scale_down_utilization")
+        self.down_checks = CONFIG.getint("autoscaling", "scale_down_checks")
+        self.down_cooldown = CONFIG.getfloat("autoscaling", "scale_down_cooldown_s")
+        self.last_change = 0.0
+        self.quiet_checks = 0
+
+    def clamp(self, size: int) -> int:
+        return min(max(size, self.min_size), self.max_size)
+
+    def update_capacity(self, size: int) -> None:
+        # Admission control estimates waits from the capacity behind the router
+        self.router.capacity = max(1, size * self.unit_capacity)
+        WORKER_COUNT.set(size)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                stats = await self.read_stats()
+            except (RedisError, ConnectionError):
+                logging.exception("[autoscaler] Failed to read worker stats")
+                continue
+            self.check(stats)
+
+    async def read_stats(self) -> list[dict]:
+        keys = [key async for key in self.db.scan_iter(match=self.stats_pattern, count=100)]
+        if not keys:
+            return []
+        return [json.loads(value) for value in await self.db.mget(keys) if value]
+
+    def check(self, stats: list[dict]) -> None:
+        size = self.pool.size
+        depth = sum(self.router.depths.values())
+        concurrency = sum(s["concurrency"] for s in stats)
+        utilization = sum(s["busy"] for s in stats) / concurrency if concurrency else 0.0
+        queue_wait_ms = max((s["queue_wait_ms"] for s in stats), default=0.0)
+        since_change = time.monotonic() - self.last_change
+
+        if size < self.min_size or (
+            size < self.max_size
+            and since_change >= self.up_cooldown
+            and (
+                depth > self.up_depth * size
+                or queue_wait_ms > self.up_wait_ms
+                or utilization > self.up_utilization
+            )
+        ):
+            self.pool.add()
+            self.changed("Scaled up", size, depth, queue_wait_ms, utilization)
+        elif (
+            depth <= self.down_depth
+            and queue_wait_ms < self.down_wait_ms
+            and utilization < self.down_utilization
+        ):
+            self.quiet_checks += 1
+            if (
+                size > self.min_size
+                and self.quiet_checks >= self.down_checks
+                and since_change >= self.down_cooldown
+            ):
+                self.pool.retire()
+                self.changed("Scaled down", size, depth, queue_wait_ms, utilization)
+        else:
+            self.quiet_checks = 0
+
+    def changed(
+        self, action: str, size: int, depth: int, queue_wait_ms: float, utilization: float
+    ) -> None:
+        self.last_change = time.monotonic()
+        self.quiet_checks = 0
+        self.update_capacity(self.pool.size)
+        logging.info(
+            "[autoscaler] %s from %s to %s (depth %s, queue wait %.0fms, utilization %.0f%%)",
+            action,
+            size,
+            self.pool.size,
+            depth,
+            queue_wait_ms,
+            utilization * 100,
+        )
@@ -5,29 +5,128 @@
 
 """
 import asyncio
+import json
 import logging
 import random
+import time
 import traceback
-from typing import Callable, TypedDict
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import partial
+from typing import AsyncContextManager, Awaitable, Callable, Hashable, TypedDict
+
+import cachetools
 
 from google.cloud import texttospeech
 
 from .config import CONFIG
 from .google_handler import GoogleHandler
+from .metrics import COMMAND_CACHE, TTS_FIRST_AUDIO
+from .profiling import profile_command
 from .reddit import meme_of_day
 
 DICE_SET = {4, 6, 8, 10, 12, 20}
 
+# Set by the worker for each job, to send part of a result before the command returns
+PARTIAL_PUBLISHER: ContextVar[Callable[[object], Awaitable[None]] | None] = ContextVar(
+    "partial_publisher", default=None
+)
+
 
 async def handle_command(command: str, params: dict | None) -> dict:
     """
     Checks command inputs and calls the needed function,
-    handling errors and the return API response
+    handling errors and the return API response.
+    For cacheable (idempotent) commands, identical requests already running share one
+    execution, with any partial results sent to every caller, and fresh cached results
+    are returned directly
     """
     params = params or {}
-    func = API_COMMANDS[command]["func"]
+    if not API_COMMANDS[command].get("cacheable"):
+        return await execute_command(command, params)
+
+    key = API_COMMANDS[command].get("cache_key", default_cache_key)(params)
+    stats = COMMAND_STATS[command]
+    cache = RESULT_CACHES.get(command)
+    if cache is not None and key in cache:
+        stats["hits"] += 1
+        COMMAND_CACHE.inc(command, "hit")
+        return cache[key]
+
+    shared = IN_FLIGHT.get((command, key))
+    if shared is not None:
+        stats["coalesced"] += 1
+        COMMAND_CACHE.inc(command, "coalesced")
+        task, partials = shared
+    else:
+        stats["misses"] += 1
+        COMMAND_CACHE.inc(command, "miss")
+        partials = PartialFanout()
+        task = asyncio.create_task(execute_shared(command, params, partials))
+        IN_FLIGHT[(command, key)] = task, partials
+        task.add_done_callback(partial(finish_cacheable, command, key))
+    await partials.join(PARTIAL_PUBLISHER.get())
+    # One caller timing out or being cancelled mustn't cancel it for the others
+    return await asyncio.shield(task)
+
+
+class PartialFanout:
+    """
+    Sends the partial results of a shared execution to every caller waiting on it,
+    replaying ones already sent to callers that join late
+    """
+
+    def __init__(self) -> None:
+        self.publishers: list[Callable[[object], Awaitable[None]]] = []
+        self.sent: list[object] = []
+
+    async def join(self, publisher: Callable[[object], Awaitable[None]] | None) -> None:
+        if publisher is None:
+            return
+        self.publishers.append(publisher)
+        for result in self.sent:
+            await publisher(result)
+
+    async def publish(self, result: object) -> None:
+        self.sent.append(result)
+        # One caller's response failing mustn't fail the command for the others
+        for error in await asyncio.gather(
+            *[publisher(result) for publisher in self.publishers], return_exceptions=True
+        ):
+            if isinstance(error, Exception):
+                logging.error("Failed to send a partial result", exc_info=error)
+
+
+async def execute_shared(command: str, params: dict, partials: PartialFanout) -> dict:
+    # The task runs in a copy of the first caller's context, publish to all callers instead
+    PARTIAL_PUBLISHER.set(partials.publish)
+    return await execute_command(command, params)
+
+
+def finish_cacheable(command: str, key: Hashable, task: asyncio.Task) -> None:
+    IN_FLIGHT.pop((command, key), None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    response = task.result()
+    cache = RESULT_CACHES.get(command)
+    if cache is not None and response["code"] == 0:
+        cache[key] = response
+
+
+def default_cache_key(params: dict) -> Hashable:
+    return json.dumps(params, sort_keys=True)
+
+
+async def execute_command(command: str, params: dict) -> dict:
+    """
+    Run the command with its timeout, turning the result or any error into the API response
+    """
+    timeout = API_COMMANDS[command].get("timeout", DEFAULT_TIMEOUT)
     try:
-        code, res = await func(*params.values())
+        code, res = await asyncio.wait_for(run_limited(command, params), timeout)
+    except asyncio.TimeoutError:
+        logging.error("Command %s timed out after %ss", command, timeout)
+        return {"code": 1, "error": {"msg": f"Command timed out after {timeout}s", "trace": ""}}
     except Exception as exc:
         logging.exception(exc)
         return {"code": 1, "error": {"msg": str(exc), "trace": traceback.format_exc()}}
@@ -38,6 +137,15 @@ async def handle_command(command: str, params: dict | None) -> dict:
     return {"code": code, "result": res}
 
 
+async def run_limited(command: str, params: dict) -> tuple[int, object]:
+    """
+    Call the command function, waiting for a slot if the command has a concurrency cap
+    """
+    limit: AsyncContextManager = COMMAND_LIMITS.get(command) or nullcontext()
+    async with limit:
+        return await profile_command(command, API_COMMANDS[command]["func"](*params.values()))
+
+
 async def test_async():
     await asyncio.sleep(2)
     return 0, "slept"
@@ -45,17 +153,38 @@ async def test_async():
 
 async def say_test(text: str):
     """
-    Create a TTS audio file for attaching with frontend
+    Create a TTS audio file for attaching with frontend, returning its path.
+    Long text is synthesized in sentence chunks in parallel then joined in order,
+    optionally publishing the first chunk early so playback can start, in which case
+    the audio after the first chunk is also returned for callers that played it
     """
-    # API call
-    logging.info("Making Google texttospeech API call")
-    resp = GoogleHandler.get_speech(text)
-
-    with open(CONFIG.get("texttospeech", "texttospeech_dir"), "wb") as file:
-        file.write(resp.audio_content)
-        logging.info("Google texttospeech response written")
-
-    return 0, ""
+    logging.info("Getting Google texttospeech audio")
+    start = time.perf_counter()
+    chunks = GoogleHandler.split_text(text, CONFIG.getint("texttospeech", "chunk_chars"))
+    tasks = [asyncio.create_task(GoogleHandler.get_speech(chunk)) for chunk in chunks]
+    publish = PARTIAL_PUBLISHER.get()
+    if len(chunks) == 1 or not CONFIG.getboolean("texttospeech", "early_first_chunk"):
+        publish = None
+    try:
+        first = await tasks[0]
+        first_audio_ms = (time.perf_counter() - start) * 1000
+        TTS_FIRST_AUDIO.observe(first_audio_ms)
+        logging.info("[tts] Time to first audio: %.1fms (%s chunks)", first_audio_ms, len(chunks))
+        if publish:
+            first_path = await GoogleHandler.write_output(first)
+            await publish({"path": first_path, "chunk": 0, "chunks": len(chunks)})
+        rest = b"".join(await asyncio.gather(*tasks[1:]))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    path = await GoogleHandler.write_output(first + rest)
+    logging.info("Google texttospeech response written to %s", path)
+    result = {"path": path}
+    if publish:
+        result["rest_path"] = await GoogleHandler.write_output(rest)
+
+    return 0, result
 
 
 async def set_google_preset(preset: str):
@@ -142,18 +271,70 @@ async def dnd_dice_roll(rolls: list[str]):
     return 0, results
 
 
-class APICommand(TypedDict):
+class _APICommandRequired(TypedDict):
     func: Callable
     params: list[str]
 
 
+class APICommand(_APICommandRequired, total=False):
+    max_concurrency: int  # per process, across all workers
+    timeout: float  # seconds, defaults to command_timeout_s
+    lane: str  # queue lane from the [lanes] config, defaults to interactive
+    # Identical concurrent requests share one execution, and successful results
+    # are cached for cache_ttl seconds (0 to only share in-flight executions)
+    cacheable: bool
+    cache_ttl: float
+    cache_key: Callable[[dict], Hashable]  # defaults to the params as sorted JSON
+
+
+DEFAULT_TIMEOUT = CONFIG.getfloat("startup", "command_timeout_s")
+
 API_COMMANDS: dict[str, APICommand] = {
-    "memeoftheday": {"func": meme_of_day, "params": []},
-    "test_async": {"func": test_async, "params": []},
-    "say_test": {"func": say_test, "params": ["text"]},
+    # Not cacheable, each caller should get their own sample
+    "memeoftheday": {
+        "func": meme_of_day,
+        "params": [],
+        "max_concurrency": 2,
+        "timeout": 30,
+        "lane": "heavy",
+    },
+    "test_async": {"func": test_async, "params": [], "timeout": 5, "lane": "heavy"},
+    "say_test": {
+        "func": say_test,
+        "params": ["text"],
+        "max_concurrency": 4,
+        "timeout": 20,
+        "lane": "heavy",
+        "cacheable": True,
+        "cache_ttl": 60,
+        "cache_key": lambda params: (
+            params["text"],
+            GoogleHandler.voice.name,
+            GoogleHandler.audio_config.pitch,
+            GoogleHandler.audio_config.speaking_rate,
+        ),
+    },
     "set_google_preset": {"func": set_google_preset, "params": ["preset"]},
     "change_google_voice": {"func": change_google_voice, "params": ["voice"]},
     "change_google_pitch": {"func": change_google_pitch, "params": ["pitch"]},
     "change_google_rate": {"func": change_google_rate, "params": ["rate"]},
     "dnd_dice_roll": {"func": dnd_dice_roll, "params": ["rolls"]},
 }
+
+COMMAND_LIMITS: dict[str, asyncio.Semaphore] = {
+    name: asyncio.Semaphore(cmd["max_concurrency"])
+    for name, cmd in API_COMMANDS.items()
+    if "max_concurrency" in cmd
+}
+
+RESULT_CACHES: dict[str, cachetools.TTLCache] = {
+    name: cachetools.TTLCache(1000, cmd["cache_ttl"])
+    for name, cmd in API_COMMANDS.items()
+    if cmd.get("cacheable") and cmd.get("cache_ttl", 0) > 0
+}
+IN_FLIGHT: dict[tuple[str, Hashable], tuple[asyncio.Task, PartialFanout]] = {}
+COMMAND_STATS: dict[str, dict[str, int]] = {
+    name: {"hits": 0, "coalesced": 0, "misses": 0}
+    for name, cmd in API_COMMANDS.items()
+    if cmd.get("cacheable")
+}
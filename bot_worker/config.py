@@ -7,7 +7,6 @@
 import configparser
 from dataclasses import dataclass
 import json
-import logging
 import os
 
 
@@ -44,12 +43,3 @@ def load_reddit_config() -> RedditConfig:
 
 REDDIT_CONF = load_reddit_config()
 
-
-def setup_logging() -> None:
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    handler = logging.FileHandler(CONFIG.get("startup", "log_file_dir"))
-    handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter("[%(asctime)s]-[%(funcName)s]-[%(levelname)s]: %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
@@ -0,0 +1,27 @@
+"""
+    discord-bot-2 backend
+
+    Shared async Redis connection pool
+
+"""
+from redis.asyncio import BlockingConnectionPool, Redis
+
+from .config import CONFIG
+
+
+def create_redis() -> Redis:
+    """
+    Create an async Redis client backed by one pool, shared by the router and all workers
+    in the process. Each blocking pop holds a connection for up to block_timeout_s, so
+    max_connections should be at least num_workers + 2
+    """
+    pool = BlockingConnectionPool(
+        host=CONFIG.get("redis", "host"),
+        port=CONFIG.getint("redis", "port"),
+        db=CONFIG.getint("redis", "db"),
+        max_connections=CONFIG.getint("redis", "max_connections"),
+        timeout=CONFIG.getfloat("redis", "pool_timeout_s"),
+        socket_timeout=CONFIG.getfloat("redis", "socket_timeout_s"),
+        socket_connect_timeout=CONFIG.getfloat("redis", "connect_timeout_s"),
+    )
+    return Redis(connection_pool=pool)
@@ -0,0 +1,148 @@
+"""
+    discord-bot-2 backend
+
+    Binary job and response envelope stored in Redis
+
+"""
+import json
+import secrets
+import struct
+from dataclasses import dataclass
+
+from .exceptions import MessageInvalidError
+
+VERSION = 3
+
+# version, flags, number of zmq frames
+_HEADER_V1 = struct.Struct("!BBB")
+# v1 fields then the deadline and the time the record was pushed, both as epoch seconds
+_HEADER_V2 = struct.Struct("!BBBdd")
+# v2 fields then the seconds the worker spent running the job, set on responses.
+# v3 also adds the optional trace after the frames
+_HEADER = struct.Struct("!BBBddd")
+_JOB_ID_LEN = struct.Struct("!B")
+_FRAME_LEN = struct.Struct("!I")
+
+# Flags
+FLAG_PARTIAL = 0x01  # an early part of the result, more responses follow for the job
+FLAG_TRACED = 0x02  # a length-prefixed trace follows the frames (v3 only)
+
+
+@dataclass
+class Envelope:
+    """
+    A job or response record: the job ID plus the raw zmq frames, where every frame but
+    the last is routing (client identity and optional empty delimiter) and the last is the payload.
+    Sampled jobs also carry a trace of (stage, monotonic time, pid, worker) stamps
+    """
+
+    job_id: str
+    frames: list[bytes]
+    flags: int = 0
+    deadline: float = 0.0  # 0 for none
+    timestamp: float = 0.0
+    execution_time: float = 0.0  # 0 for jobs, or responses from older workers
+    trace: list[list] | None = None
+
+    @property
+    def routing(self) -> list[bytes]:
+        return self.frames[:-1]
+
+    @property
+    def payload(self) -> bytes:
+        return self.frames[-1]
+
+    @property
+    def is_partial(self) -> bool:
+        return bool(self.flags & FLAG_PARTIAL)
+
+    def is_expired(self, now: float) -> bool:
+        return 0 < self.deadline < now
+
+
+def new_job_id(origin: str) -> str:
+    """
+    Job IDs carry the ID of the router they came in on, so the response can find its way back
+    """
+    return f"{origin}:{secrets.token_hex(16)}"
+
+
+def origin_of(job_id: str) -> str:
+    return job_id.rpartition(":")[0]
+
+
+def pack(envelope: Envelope) -> bytes:
+    """
+    Encode as: header, length-prefixed job ID, each frame length-prefixed,
+    then the trace as length-prefixed JSON if there is one
+    """
+    job_id = envelope.job_id.encode()
+    flags = envelope.flags & ~FLAG_TRACED
+    if envelope.trace is not None:
+        flags |= FLAG_TRACED
+    parts = [
+        _HEADER.pack(
+            VERSION,
+            flags,
+            len(envelope.frames),
+            envelope.deadline,
+            envelope.timestamp,
+            envelope.execution_time,
+        ),
+        _JOB_ID_LEN.pack(len(job_id)),
+        job_id,
+    ]
+    for frame in envelope.frames:
+        parts.append(_FRAME_LEN.pack(len(frame)))
+        parts.append(frame)
+    if envelope.trace is not None:
+        trace = json.dumps(envelope.trace, separators=(",", ":")).encode()
+        parts.append(_FRAME_LEN.pack(len(trace)))
+        parts.append(trace)
+    return b"".join(parts)
+
+
+def unpack(data: bytes) -> Envelope:
+    """
+    Decode a packed envelope, raising MessageInvalidError if it is malformed
+    """
+    try:
+        version = data[0]
+        deadline, timestamp, execution_time = 0.0, 0.0, 0.0
+        if version == VERSION:
+            _, flags, num_frames, deadline, timestamp, execution_time = _HEADER.unpack_from(data, 0)
+            offset = _HEADER.size
+        elif version == 2:
+            _, flags, num_frames, deadline, timestamp = _HEADER_V2.unpack_from(data, 0)
+            offset = _HEADER_V2.size
+        elif version == 1:
+            _, flags, num_frames = _HEADER_V1.unpack_from(data, 0)
+            offset = _HEADER_V1.size
+        else:
+            raise MessageInvalidError(f"Unsupported envelope version: {version}")
+
+        (id_len,) = _JOB_ID_LEN.unpack_from(data, offset)
+        offset += _JOB_ID_LEN.size
+        job_id = data[offset : offset + id_len].decode()
+        offset += id_len
+
+        frames = []
+        for _ in range(num_frames):
+            (frame_len,) = _FRAME_LEN.unpack_from(data, offset)
+            offset += _FRAME_LEN.size
+            frames.append(data[offset : offset + frame_len])
+            offset += frame_len
+
+        trace = None
+        if version == VERSION and flags & FLAG_TRACED:
+            (trace_len,) = _FRAME_LEN.unpack_from(data, offset)
+            offset += _FRAME_LEN.size
+            trace = json.loads(data[offset : offset + trace_len])
+            offset += trace_len
+    except (struct.error, UnicodeDecodeError, IndexError, ValueError) as exc:
+        raise MessageInvalidError("Envelope malformed") from exc
+
+    if offset != len(data) or not frames:
+        raise MessageInvalidError("Envelope malformed")
+
+    return Envelope(job_id, frames, flags, deadline, timestamp, execution_time, trace)
@@ -1,2 +1,2 @@
-class MessageInvalidError(BaseException):
+class MessageInvalidError(Exception):
     ...
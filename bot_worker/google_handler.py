@@ -4,13 +4,21 @@
     Google services handling
 
 """
+import asyncio
 import json
 import logging
+import os
+import re
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import TypedDict
 
 from google.cloud import texttospeech
 
 from .config import CONFIG
+from .tts_cache import AudioCache
 
 
 class VoicePreset(TypedDict):
@@ -27,6 +35,9 @@ def load_voice_presets() -> dict[str, VoicePreset]:
     return preset_data
 
 
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
 class GoogleHandler:
     """
     Static helper class to handle interfaces to Google APIs
@@ -38,11 +49,22 @@ class GoogleHandler:
     voice: texttospeech.VoiceSelectionParams
     client: texttospeech.TextToSpeechClient
     voice_list: list[str] = []
+    cache: AudioCache | None = None
+    # The client is synchronous, so calls run here off the event loop, at most max_workers at once
+    executor: ThreadPoolExecutor
+    output_dir: str
+    last_prune = 0.0
 
     @classmethod
-    def initialise(cls) -> None:
+    def initialise(cls, process_index: int | None = None, num_processes: int = 1) -> None:
         logging.info("Connecting to Google...")
         cls.client = texttospeech.TextToSpeechClient()
+        cls.executor = ThreadPoolExecutor(
+            max_workers=CONFIG.getint("texttospeech", "synthesis_concurrency"),
+            thread_name_prefix="tts",
+        )
+        cls.output_dir = CONFIG.get("texttospeech", "output_dir")
+        os.makedirs(cls.output_dir, exist_ok=True)
 
         settings = cls.VOICE_PRESETS["default"]
         cls.voice = texttospeech.VoiceSelectionParams(
@@ -57,16 +79,96 @@ class GoogleHandler:
         cls.voice_list = [
             voice.name for voice in cls.client.list_voices(texttospeech.ListVoicesRequest()).voices
         ]
+        cache_dir = CONFIG.get("texttospeech", "cache_dir")
+        disk_bytes = CONFIG.getint("texttospeech", "cache_disk_mb") * 1024 * 1024
+        if process_index is not None:
+            # Each process only tracks its own files, so it gets its own directory
+            # and share of the disk limit
+            cache_dir = os.path.join(cache_dir, str(process_index))
+            disk_bytes //= num_processes
+        cls.cache = AudioCache(
+            cache_dir, CONFIG.getint("texttospeech", "cache_memory_mb") * 1024 * 1024, disk_bytes
+        )
         logging.info("Initialised Google connection")
 
     @classmethod
-    def get_speech(cls, input: str) -> texttospeech.SynthesizeSpeechResponse:
+    async def get_speech(cls, input: str) -> bytes:
         """
-        Request TTS audio binary of input phrase
+        Get TTS audio binary of input phrase, from the cache if it's been said
+        with the same voice settings before
         """
-        resp = cls.client.synthesize_speech(
-            input=texttospeech.SynthesisInput(text=input),
-            audio_config=cls.audio_config,
-            voice=cls.voice,
+        voice, audio_config = cls.voice, cls.audio_config
+        key = AudioCache.key(input, voice, audio_config)
+        audio = await cls.cache.get(key) if cls.cache else None
+        if audio is not None:
+            return audio
+
+        resp = await asyncio.get_running_loop().run_in_executor(
+            cls.executor,
+            partial(
+                cls.client.synthesize_speech,
+                input=texttospeech.SynthesisInput(text=input),
+                audio_config=audio_config,
+                voice=voice,
+            ),
         )
-        return resp
+        if cls.cache:
+            await cls.cache.put(key, resp.audio_content)
+        return resp.audio_content
+
+    @staticmethod
+    def split_text(text: str, max_chars: int) -> list[str]:
+        """
+        Split text into chunks of whole sentences up to max_chars long,
+        falling back to splitting on words for any longer sentence
+        """
+        chunks: list[str] = []
+        current = ""
+        for sentence in SENTENCE_END.split(text.strip()):
+            pieces = [sentence]
+            if len(sentence) > max_chars:
+                pieces, piece = [], ""
+                for word in sentence.split():
+                    if piece and len(piece) + len(word) + 1 > max_chars:
+                        pieces.append(piece)
+                        piece = ""
+                    piece = f"{piece} {word}" if piece else word
+                pieces.append(piece)
+
+            for piece in pieces:
+                if current and len(current) + len(piece) + 1 > max_chars:
+                    chunks.append(current)
+                    current = ""
+                current = f"{current} {piece}" if current else piece
+        chunks.append(current)
+        return chunks
+
+    @classmethod
+    async def write_output(cls, audio: bytes) -> str:
+        """
+        Write audio to a new file for this job and return its path
+        """
+        path = os.path.join(cls.output_dir, f"{secrets.token_hex(8)}.mp3")
+        await asyncio.to_thread(cls._write, path, audio)
+        if time.time() - cls.last_prune > 60:
+            cls.last_prune = time.time()
+            await asyncio.to_thread(cls.prune_outputs)
+        return path
+
+    @staticmethod
+    def _write(path: str, audio: bytes) -> None:
+        with open(path, "wb") as file:
+            file.write(audio)
+
+    @classmethod
+    def prune_outputs(cls) -> None:
+        """
+        Remove output files old enough that the frontend is done with them
+        """
+        cutoff = time.time() - CONFIG.getint("texttospeech", "output_ttl_s")
+        for entry in os.scandir(cls.output_dir):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,47 @@
+"""
+    discord-bot-2 backend
+
+    Shared HTTP client for outbound APIs
+
+"""
+import logging
+
+import aiohttp
+
+from .config import CONFIG
+
+
+class HttpClient:
+    """
+    Static holder of one long-lived aiohttp session per process, so outbound requests reuse
+    pooled keep-alive connections and cached DNS lookups
+    """
+
+    session: aiohttp.ClientSession | None = None
+
+    @classmethod
+    async def start(cls) -> None:
+        connector = aiohttp.TCPConnector(
+            limit=CONFIG.getint("http", "max_connections"),
+            limit_per_host=CONFIG.getint("http", "max_connections_per_host"),
+            ttl_dns_cache=CONFIG.getint("http", "dns_cache_s"),
+            keepalive_timeout=CONFIG.getfloat("http", "keepalive_s"),
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=CONFIG.getfloat("http", "total_timeout_s"),
+            sock_connect=CONFIG.getfloat("http", "connect_timeout_s"),
+        )
+        cls.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        logging.info("Started HTTP client")
+
+    @classmethod
+    def get(cls) -> aiohttp.ClientSession:
+        if cls.session is None:
+            raise RuntimeError("HTTP client not started")
+        return cls.session
+
+    @classmethod
+    async def close(cls) -> None:
+        if cls.session is not None:
+            await cls.session.close()
+            cls.session = None
@@ -0,0 +1,131 @@
+"""
+    discord-bot-2 backend
+
+    In-flight job table with timer wheel expiry
+
+"""
+import time
+from dataclasses import dataclass, field
+
+from .timing import NS_IN_MS
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel. Level 0 has `slots` slots of one tick each, and each level
+    above has `slots` slots spanning a whole rotation of the level below. Scheduling and
+    cancelling are O(1), and timers cascade down a level as their expiry gets close
+    """
+
+    def __init__(self, tick: float, slots: int = 64, levels: int = 4) -> None:
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.start = time.monotonic()
+        self.current = 0  # ticks since start
+        self.wheels: list[list[set[str]]] = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.timers: dict[str, tuple[int, int, int]] = {}  # key -> expiry tick, level, slot
+
+    def schedule(self, key: str, when: float) -> None:
+        """
+        Schedule key to expire at monotonic time `when`, replacing any timer it already has
+        """
+        self.cancel(key)
+        expiry = max(int((when - self.start) / self.tick) + 1, self.current + 1)
+        self._place(key, expiry)
+
+    def _place(self, key: str, expiry: int) -> None:
+        # Lowest level whose current rotation the expiry falls within
+        for level in range(self.levels - 1):
+            span = self.slots ** (level + 1)
+            if expiry // span == self.current // span:
+                slot = (expiry // self.slots**level) % self.slots
+                break
+        else:
+            level = self.levels - 1
+            size = self.slots**level
+            if expiry // size - self.current // size < self.slots:
+                slot = (expiry // size) % self.slots
+            else:
+                # Beyond the top level, park in the slot it will reach last and re-place then
+                slot = (self.current // size - 1) % self.slots
+
+        self.wheels[level][slot].add(key)
+        self.timers[key] = (expiry, level, slot)
+
+    def cancel(self, key: str) -> None:
+        if key in self.timers:
+            _, level, slot = self.timers.pop(key)
+            self.wheels[level][slot].discard(key)
+
+    def advance(self, now: float) -> list[str]:
+        """
+        Move the wheel on to monotonic time `now` and return the keys that expired
+        """
+        expired = []
+        target = int((now - self.start) / self.tick)
+        while self.current < target:
+            self.current += 1
+            # Cascade from the top so timers can fall more than one level in a tick
+            for level in range(self.levels - 1, 0, -1):
+                if self.current % self.slots**level == 0:
+                    slot = (self.current // self.slots**level) % self.slots
+                    keys, self.wheels[level][slot] = self.wheels[level][slot], set()
+                    for key in keys:
+                        expiry, _, _ = self.timers.pop(key)
+                        self._place(key, expiry)
+
+            slot = self.current % self.slots
+            keys, self.wheels[0][slot] = self.wheels[0][slot], set()
+            for key in keys:
+                del self.timers[key]
+            expired.extend(keys)
+        return expired
+
+    def __len__(self) -> int:
+        return len(self.timers)
+
+
+@dataclass
+class InFlightJob:
+    routing: list[bytes]  # client identity and optional empty delimiter
+    command: str
+    deadline: float  # monotonic
+    started_ns: int = field(default_factory=time.monotonic_ns)
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic_ns() - self.started_ns) / NS_IN_MS
+
+
+class InFlightTable:
+    """
+    Jobs the router is waiting on a response for, with no cap on size.
+    Jobs past their deadline are expired through a timer wheel
+    """
+
+    def __init__(self, tick: float) -> None:
+        self.jobs: dict[str, InFlightJob] = {}
+        self.wheel = TimerWheel(tick)
+
+    def __contains__(self, job_id: str) -> bool:
+        return job_id in self.jobs
+
+    def __len__(self) -> int:
+        return len(self.jobs)
+
+    def add(self, job_id: str, routing: list[bytes], command: str, timeout: float) -> None:
+        job = InFlightJob(routing, command, time.monotonic() + timeout)
+        self.jobs[job_id] = job
+        self.wheel.schedule(job_id, job.deadline)
+
+    def get(self, job_id: str) -> InFlightJob | None:
+        return self.jobs.get(job_id)
+
+    def pop(self, job_id: str) -> InFlightJob | None:
+        self.wheel.cancel(job_id)
+        return self.jobs.pop(job_id, None)
+
+    def expire(self) -> list[tuple[str, InFlightJob]]:
+        return [
+            (job_id, self.jobs.pop(job_id)) for job_id in self.wheel.advance(time.monotonic())
+        ]
@@ -0,0 +1,54 @@
+"""
+    discord-bot-2 backend
+
+    Priority lanes for the job queue
+
+"""
+import json
+
+from .commands import API_COMMANDS
+from .config import CONFIG
+
+DEFAULT_LANE = "interactive"
+LANE_WEIGHTS: dict[str, int] = {lane: CONFIG.getint("lanes", lane) for lane in CONFIG["lanes"]}
+
+
+def lane_queue(queue: str, lane: str) -> str:
+    return f"{queue}:{lane}"
+
+
+def command_of(payload: bytes) -> str:
+    """
+    Read the command of a raw client message, or an empty string for anything unreadable,
+    which is left to the worker to reject
+    """
+    try:
+        command = json.loads(payload).get("command", "")
+    except (ValueError, AttributeError):
+        return ""
+    return command if command in API_COMMANDS else ""
+
+
+def lane_for(command: str) -> str:
+    if command not in API_COMMANDS:
+        return DEFAULT_LANE
+    return API_COMMANDS[command].get("lane", DEFAULT_LANE)
+
+
+class LaneScheduler:
+    """
+    Smooth weighted round robin over the lanes. Each pick gives the order to try the lanes in,
+    so a busy lane gets its share by weight while an empty one doesn't hold anything up
+    """
+
+    def __init__(self, weights: dict[str, int] = LANE_WEIGHTS) -> None:
+        self.weights = weights
+        self.total = sum(weights.values())
+        self.current = {lane: 0 for lane in weights}
+
+    def order(self) -> list[str]:
+        for lane, weight in self.weights.items():
+            self.current[lane] += weight
+        lanes = sorted(self.current, key=self.current.__getitem__, reverse=True)
+        self.current[lanes[0]] -= self.total
+        return lanes
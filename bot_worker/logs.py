@@ -0,0 +1,187 @@
+"""
+    discord-bot-2 backend
+
+    Log pipeline writing to disk from a background thread
+
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+from .config import CONFIG
+from .metrics import LOGS_DROPPED
+
+FORMAT = "[%(asctime)s]-[%(funcName)s]-[%(levelname)s]: %(message)s"
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to the writer thread through a bounded queue, dropping them
+    rather than blocking the caller when the writer has fallen behind
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOGS_DROPPED.inc()
+
+
+class SubsystemFilter(logging.Filter):
+    """
+    Applies the level configured for the module a record was logged from, or the default level
+    """
+
+    def __init__(self, default: int, levels: dict[str, int]) -> None:
+        super().__init__()
+        self.default = default
+        self.levels = levels
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= self.levels.get(record.module, self.default)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `rate` INFO and DEBUG records a second from each logging call,
+    so per-job lines can't flood the log at high load. Warnings and errors always pass,
+    and the next line let through from a call says how many were suppressed
+    """
+
+    def __init__(self, rate: int) -> None:
+        super().__init__()
+        self.rate = rate
+        # (file, line) -> [start of window, records passed, records suppressed]
+        self.windows: dict[tuple[str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.rate or record.levelno > logging.INFO:
+            return True
+        key = (record.pathname, record.lineno)
+        window = self.windows.get(key)
+        if window is None or record.created - window[0] >= 1:
+            if window is not None and window[2]:
+                record.msg = f"{record.msg} ({window[2]} similar lines suppressed)"
+            self.windows[key] = [record.created, 1, 0]
+            return True
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class LogWriter(threading.Thread):
+    """
+    Writes queued records to the target handler's file in batches, flushing once per batch,
+    and rolling the file over first if the target is a rotating handler
+    """
+
+    def __init__(self, target: logging.FileHandler, handler: DroppingQueueHandler) -> None:
+        super().__init__(name="log-writer", daemon=True)
+        self.target = target
+        self.handler = handler
+        self.queue: queue.Queue = handler.queue
+        self.batch_size = CONFIG.getint("logging", "batch_size")
+        self.flush_interval = CONFIG.getfloat("logging", "flush_interval_s")
+        self.reported_dropped = 0
+        self.stopped = False
+
+    def run(self) -> None:
+        while not self.stopped:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self.write(batch)
+
+    def write(self, batch: list[logging.LogRecord | None]) -> None:
+        if None in batch:
+            self.stopped = True
+        target = self.target
+        try:
+            for record in batch:
+                if record is None:
+                    continue
+                if isinstance(target, RotatingFileHandler) and target.shouldRollover(record):
+                    target.doRollover()
+                target.stream.write(f"{target.format(record)}\n")
+
+            dropped = self.handler.dropped - self.reported_dropped
+            if dropped:
+                self.reported_dropped += dropped
+                target.stream.write(
+                    f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Dropped {dropped} log records\n"
+                )
+            target.flush()
+        except OSError:
+            # Nowhere left to report it, carry on so the queue keeps draining
+            pass
+
+    def stop(self) -> None:
+        """
+        Write out what is queued then close the file
+        """
+        try:
+            self.queue.put(None, timeout=1)
+        except queue.Full:
+            return
+        self.join(timeout=5)
+        self.target.close()
+
+
+def start_writer(target: logging.FileHandler) -> DroppingQueueHandler:
+    """
+    Start a writer thread for the target, returning the handler that queues records for it
+    """
+    handler = DroppingQueueHandler(queue.Queue(CONFIG.getint("logging", "queue_size")))
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    writer = LogWriter(target, handler)
+    writer.start()
+    atexit.register(writer.stop)
+    return handler
+
+
+def parse_level(name: str, setting: str) -> int:
+    """
+    Level number for a level name, raising ValueError naming the setting if it is unknown
+    """
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level for {setting}: {name}")
+    return level
+
+
+def setup_logging() -> None:
+    """
+    Route all logging through a bounded queue to a writer thread, so the event loop never
+    waits on the disk. Levels can be set per module in the [log_levels] config section
+    """
+    default = parse_level(CONFIG.get("logging", "level"), "[logging] level")
+    levels = {
+        module: parse_level(level, f"[log_levels] {module}")
+        for module, level in CONFIG.items("log_levels")
+        if module not in CONFIG.defaults()
+    }
+
+    target = logging.FileHandler(CONFIG.get("startup", "log_file_dir"), encoding="utf-8")
+    target.setFormatter(logging.Formatter(FORMAT))
+    handler = start_writer(target)
+    handler.addFilter(SubsystemFilter(default, levels))
+    handler.addFilter(RateLimitFilter(CONFIG.getint("logging", "max_per_line_per_s")))
+
+    logger = logging.getLogger()
+    # Records below every configured level are dropped before any work is done on them
+    logger.setLevel(min([default, *levels.values()]))
+    logger.addHandler(handler)
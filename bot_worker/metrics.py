@@ -0,0 +1,170 @@
+"""
+    discord-bot-2 backend
+
+    Latency histograms, gauges and counters served in Prometheus text format
+
+"""
+import asyncio
+import logging
+from bisect import bisect_left
+
+from .config import CONFIG
+
+# Upper bounds in ms, roughly logarithmic from sub-millisecond Redis hops up to slow API calls
+BUCKETS_MS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+REGISTRY: list["Metric"] = []
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        REGISTRY.append(self)
+
+    def label_str(self, values: tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        return super().render() + [
+            f"{self.name}{self.label_str(values)} {value}" for values, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values: str) -> None:
+        self.values[label_values] = value
+
+    def remove(self, *label_values: str) -> None:
+        self.values.pop(label_values, None)
+
+
+class Histogram(Metric):
+    """
+    Counts of observations in fixed buckets, enough to estimate p50/p95/p99 at scrape time
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = BUCKETS_MS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # per label values: a count for each bucket plus +Inf, then the sum of observations
+        self.series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for values, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = self.label_str(values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{self.label_str(values)} {total[0]}")
+            lines.append(f"{self.name}_count{self.label_str(values)} {cumulative}")
+        return lines
+
+
+def render() -> bytes:
+    return ("\n".join(line for metric in REGISTRY for line in metric.render()) + "\n").encode()
+
+
+INGRESS_TO_ENQUEUE = Histogram(
+    "ingress_to_enqueue_ms", "Time from a message arriving to its job being queued", ("command",)
+)
+QUEUE_WAIT = Histogram("queue_wait_ms", "Time a job waited in the queue", ("command",))
+EXECUTION = Histogram("execution_ms", "Time spent running a command", ("command",))
+RESPONSE_WAIT = Histogram(
+    "response_wait_ms", "Time from a response being put to it being sent", ("command",)
+)
+JOB_TIME = Histogram("job_ms", "Time from a job being queued to its response", ("command",))
+TTS_FIRST_AUDIO = Histogram("tts_first_audio_ms", "Time to the first chunk of TTS audio")
+LOOP_LAG = Histogram("loop_lag_ms", "How late the event loop woke from a short sleep")
+QUEUE_DEPTH = Gauge("queue_depth", "Jobs waiting in each queue", ("queue",))
+IN_FLIGHT = Gauge("in_flight_jobs", "Jobs waiting on a response")
+WORKER_UTILIZATION = Gauge(
+    "worker_utilization", "Share of a worker's job slots in use", ("worker",)
+)
+WORKER_COUNT = Gauge("workers", "Workers, or worker processes, run by the autoscaler")
+REJECTED = Counter("jobs_rejected_total", "Jobs turned away by admission control")
+TIMED_OUT = Counter("jobs_timed_out_total", "Jobs with no response by their deadline")
+COMMAND_CACHE = Counter(
+    "command_cache_total",
+    "Calls of cacheable commands by how they were served: hit, coalesced or miss",
+    ("command", "result"),
+)
+TTS_CACHE = Counter(
+    "tts_cache_total", "TTS audio lookups by the cache tier that served them, or miss", ("tier",)
+)
+LOGS_DROPPED = Counter("log_records_dropped_total", "Log records dropped with the log queue full")
+
+
+async def serve_metrics(port_offset: int = 0) -> None:
+    """
+    Serve the metrics of this process over HTTP. Each process has its own,
+    so worker processes use the configured port plus their offset
+    """
+    host = CONFIG.get("metrics", "host")
+    port = CONFIG.getint("metrics", "port") + port_offset
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = render()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    try:
+        server = await asyncio.start_server(handle, host, port)
+    except OSError:
+        # Metrics are optional, don't take the server down with them
+        logging.exception("Failed to serve metrics on %s:%s, running without them", host, port)
+        return
+    logging.info("Serving metrics at http://%s:%s/metrics", host, port)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,272 @@
+"""
+    discord-bot-2 backend
+
+    On-demand profiling of commands and the event loop, and event loop lag monitoring
+
+"""
+import asyncio
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+import types
+from collections import Counter
+from typing import Coroutine
+
+from redis.asyncio import Redis
+
+from .config import CONFIG
+from .metrics import LOOP_LAG
+
+MODES = ("deterministic", "sample")
+PROFILE_COMMAND = "admin_profile"
+PROFILE_CHANNEL = "profiling"
+
+
+class ProfileSession:
+    """
+    Profiles the event loop thread for a number of seconds, either deterministically with
+    cProfile or by sampling its stack from another thread. With a command set, only time
+    spent running that command is profiled, then results are written to the output directory
+    """
+
+    def __init__(self, mode: str, seconds: float, command: str | None = None) -> None:
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode: {mode}")
+        max_seconds = CONFIG.getfloat("profiling", "max_seconds")
+        if not 0 < seconds <= max_seconds:
+            raise ValueError(f"Profiling time must be between 0 and {max_seconds}s")
+        self.mode = mode
+        self.seconds = seconds
+        self.command = command
+        self.profile = cProfile.Profile()
+        self.samples: Counter[str] = Counter()
+        self.codes: set[types.CodeType] = set()  # code of the profiled command's coroutines
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+
+    async def run(self) -> None:
+        logging.info(
+            "[profiling] Started %s profiling of %s for %ss",
+            self.mode,
+            self.command or "the event loop",
+            self.seconds,
+        )
+        sampler = None
+        if self.mode == "sample":
+            sampler = threading.Thread(target=self.sample, name="profile-sampler", daemon=True)
+            sampler.start()
+        elif self.command is None:
+            self.profile.enable()
+        try:
+            await asyncio.sleep(self.seconds)
+        finally:
+            if sampler:
+                self.stopped.set()
+                sampler.join()
+            elif self.command is None:
+                self.profile.disable()
+            await asyncio.get_running_loop().run_in_executor(None, self.write)
+
+    def wrap(self, coro: Coroutine) -> Coroutine:
+        if self.mode == "sample":
+            self.codes.add(coro.cr_code)
+            return coro
+        return profiled(coro, self.profile)
+
+    def sample(self) -> None:
+        """
+        Count the loop thread's stacks, folded root first as flame graph tools expect
+        """
+        interval = CONFIG.getfloat("profiling", "sample_interval_ms") / 1000
+        while not self.stopped.wait(interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                if code in self.codes:
+                    break
+                frame = frame.f_back
+            else:
+                if self.command is not None:
+                    continue
+            self.samples[";".join(reversed(stack))] += 1
+
+    def write(self) -> None:
+        output_dir = CONFIG.get("profiling", "output_dir")
+        os.makedirs(output_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.command or 'loop'}"
+        path = os.path.join(output_dir, name)
+        if self.mode == "sample":
+            path += ".folded"
+            with open(path, "w") as file:
+                for stack, count in self.samples.most_common():
+                    file.write(f"{stack} {count}\n")
+        else:
+            self.profile.dump_stats(f"{path}.prof")
+            summary = io.StringIO()
+            stats = pstats.Stats(self.profile, stream=summary)
+            stats.sort_stats("cumulative").print_stats(50)
+            path += ".txt"
+            with open(path, "w") as file:
+                file.write(summary.getvalue())
+        logging.info("[profiling] Wrote profile to %s", path)
+
+
+@types.coroutine
+def profiled(coro: Coroutine, profile: cProfile.Profile):
+    """
+    Drive a coroutine with the profiler enabled only while it is running,
+    so other jobs interleaved on the loop are left out
+    """
+    value, error = None, None
+    while True:
+        profile.enable()
+        try:
+            if error is not None:
+                yielded = coro.throw(error)
+            else:
+                yielded = coro.send(value)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            profile.disable()
+
+        try:
+            value, error = (yield yielded), None
+        except BaseException as exc:
+            value, error = None, exc
+
+
+SESSION: ProfileSession | None = None
+SESSION_TASK: asyncio.Task | None = None
+
+
+def start_profiling(mode: str, seconds: float, command: str | None = None) -> None:
+    """
+    Start a profiling session in this process, raising ValueError if one is already running
+    or the request is invalid
+    """
+    global SESSION, SESSION_TASK
+    if SESSION is not None:
+        raise ValueError("A profiling session is already running")
+    SESSION = ProfileSession(mode, seconds, command)
+    SESSION_TASK = asyncio.create_task(SESSION.run())
+    SESSION_TASK.add_done_callback(end_session)
+
+
+def end_session(task: asyncio.Task) -> None:
+    global SESSION, SESSION_TASK
+    SESSION, SESSION_TASK = None, None
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("[profiling] Profiling failed", exc_info=task.exception())
+
+
+def profile_command(command: str, coro: Coroutine) -> Coroutine:
+    """
+    Hand back a command's coroutine, wrapped to be profiled if a session is profiling it
+    """
+    if SESSION is None or SESSION.command != command:
+        return coro
+    return SESSION.wrap(coro)
+
+
+def start_from_signal() -> None:
+    try:
+        start_profiling(
+            CONFIG.get("profiling", "default_mode"), CONFIG.getfloat("profiling", "default_seconds")
+        )
+    except ValueError as exc:
+        logging.warning("[profiling] %s", exc)
+
+
+def handle_profile_signal() -> None:
+    """
+    Start profiling the whole loop with the default settings on SIGUSR1
+    """
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, start_from_signal)
+
+
+def parse_request(params: dict) -> tuple[str, float, str | None]:
+    return (
+        params.get("mode", CONFIG.get("profiling", "default_mode")),
+        float(params.get("seconds", CONFIG.getfloat("profiling", "default_seconds"))),
+        params.get("command") or None,
+    )
+
+
+async def listen_for_profile_requests(db: Redis) -> None:
+    """
+    Start profiling when the router broadcasts a request to the worker processes
+    """
+    pubsub = db.pubsub()
+    await pubsub.subscribe(PROFILE_CHANNEL)
+    try:
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            try:
+                start_profiling(*parse_request(json.loads(message["data"])))
+            except ValueError as exc:
+                logging.warning("[profiling] Ignored profiling request: %s", exc)
+    finally:
+        await pubsub.unsubscribe(PROFILE_CHANNEL)
+        await pubsub.close()
+
+
+class LoopWatchdog(threading.Thread):
+    """
+    Logs the loop thread's stack when the loop has gone longer than the threshold
+    without a heartbeat, to catch blocking calls in the act
+    """
+
+    def __init__(self, threshold: float) -> None:
+        super().__init__(name="loop-watchdog", daemon=True)
+        self.threshold = threshold
+        self.loop_thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+
+    def run(self) -> None:
+        reported = 0.0
+        while True:
+            time.sleep(self.threshold / 2)
+            beat = self.beat
+            blocked = time.monotonic() - beat
+            if blocked < self.threshold or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                logging.warning(
+                    "[profiling] Event loop blocked for over %.0fms in:\n%s",
+                    blocked * 1000,
+                    "".join(traceback.format_stack(frame)),
+                )
+
+
+async def monitor_loop_lag() -> None:
+    """
+    Measure how late the loop wakes from short sleeps, which is time spent in blocking calls
+    or long stretches of CPU work between awaits
+    """
+    interval = CONFIG.getfloat("profiling", "loop_lag_interval_ms") / 1000
+    threshold = CONFIG.getfloat("profiling", "loop_lag_threshold_ms") / 1000
+    watchdog = LoopWatchdog(interval + threshold)
+    watchdog.start()
+    while True:
+        start = time.monotonic()
+        watchdog.beat = start
+        await asyncio.sleep(interval)
+        lag = time.monotonic() - start - interval
+        LOOP_LAG.observe(lag * 1000)
+        if lag > threshold:
+            logging.warning("[profiling] Event loop lagged by %.1fms", lag * 1000)
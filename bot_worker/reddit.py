@@ -1,66 +1,249 @@
 import asyncio
+import logging
 import random
 import time
+from typing import Mapping
 
 import aiohttp
 
-from .config import REDDIT_CONF
+from .config import CONFIG, REDDIT_CONF
+from .http_client import HttpClient
+from .sampling import MemeIndex
 
 
-async def meme_of_day() -> tuple[int, dict]:
+class MemePool:
     """
-    returns image url with title, subreddit and author -randomly selected from output of scrape_subreddit
+    Static in-memory pool of scraped memes, refreshed in the background on a schedule.
+    Once the pool is older than its TTL it is still served while a refresh runs
     """
-    async with aiohttp.ClientSession() as session:
+
+    index = MemeIndex(CONFIG.getint("reddit", "exclude_recent"))
+    refreshed_at = 0.0
+    refresh_task: asyncio.Task | None = None
+    refresh_interval = CONFIG.getint("reddit", "refresh_interval_s")
+    ttl = CONFIG.getint("reddit", "ttl_s")
+
+    @classmethod
+    async def run(cls) -> None:
+        """
+        Refresh the pool every refresh interval until cancelled
+        """
+        while True:
+            try:
+                await cls.refresh()
+            except Exception:
+                # Logged by the refresh task's callback
+                pass
+            await asyncio.sleep(cls.refresh_interval)
+
+    @classmethod
+    def refresh(cls) -> asyncio.Task:
+        """
+        Start a refresh, or join the one already running
+        """
+        if cls.refresh_task is None or cls.refresh_task.done():
+            cls.refresh_task = asyncio.create_task(cls._refresh())
+            cls.refresh_task.add_done_callback(cls.refresh_done)
+        return cls.refresh_task
+
+    @staticmethod
+    def refresh_done(task: asyncio.Task) -> None:
+        """
+        Log a failed refresh, including ones started in the background that nothing awaits
+        """
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("[reddit] Failed to refresh meme pool", exc_info=task.exception())
+
+    @classmethod
+    async def _refresh(cls) -> None:
         ##get authorisation
-        await set_auth(session)
+        await set_auth()
 
-        coros = [
-            scrape_subreddit(session, sub, time="week", lim=20) for sub in REDDIT_CONF.subreddits
-        ]
+        coros = [scrape_subreddit(sub, time="week", lim=20) for sub in REDDIT_CONF.subreddits]
 
         memes = []
         for result in await asyncio.gather(*coros):
             memes.extend(result)
 
-    selection = random.randrange(0, len(memes))
-    return 0, memes[selection]
+        if memes:
+            cls.index.update(memes)
+            cls.refreshed_at = time.time()
+        logging.info("[reddit] Refreshed meme pool with %s memes", len(memes))
+
+    @classmethod
+    async def sample(cls) -> dict | None:
+        if not cls.index:
+            await cls.refresh()
+        elif time.time() - cls.refreshed_at > cls.ttl:
+            cls.refresh()
+        return cls.index.sample()
+
+
+async def meme_of_day() -> tuple[int, dict | str]:
+    """
+    returns image url with title, subreddit and author -selected from the meme pool by score
+    """
+    meme = await MemePool.sample()
+    if meme is None:
+        return 1, "No memes available"
+    return 0, meme
+
+
+class RedditScheduler:
+    """
+    Static pacer for Reddit API requests. The X-Ratelimit-* headers of each response give
+    the requests remaining in the current window, which are spread evenly over the time left.
+    429 and 5xx responses are retried with jittered exponential backoff
+    """
+
+    remaining: float | None = None
+    reset_at = 0.0
+    next_at = 0.0
+    lock = asyncio.Lock()
+    slots = asyncio.Semaphore(CONFIG.getint("reddit", "max_concurrency"))
+    max_retries = CONFIG.getint("reddit", "max_retries")
+    backoff_base = CONFIG.getfloat("reddit", "backoff_base_s")
+    backoff_max = CONFIG.getfloat("reddit", "backoff_max_s")
+
+    @classmethod
+    async def wait_turn(cls) -> None:
+        async with cls.lock:
+            now = time.monotonic()
+            # Nothing known about the current window yet, so nothing to pace by
+            if cls.remaining is None or now >= cls.reset_at:
+                return
+            if cls.remaining < 1:
+                logging.warning("[reddit] Rate limit used up, waiting %.1fs", cls.reset_at - now)
+                await asyncio.sleep(cls.reset_at - now)
+                cls.remaining = None
+                return
+            start = max(now, cls.next_at)
+            cls.next_at = start + (cls.reset_at - now) / cls.remaining
+            cls.remaining -= 1
+            if start > now:
+                await asyncio.sleep(start - now)
+
+    @classmethod
+    def update(cls, headers: Mapping[str, str]) -> None:
+        try:
+            remaining = float(headers["X-Ratelimit-Remaining"])
+            reset = float(headers["X-Ratelimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        cls.remaining = remaining
+        cls.reset_at = time.monotonic() + reset
 
+    @classmethod
+    def backoff(cls, attempt: int, retry_after: str | None) -> float:
+        delay = random.uniform(0, min(cls.backoff_max, cls.backoff_base * 2**attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return delay
+
+    @classmethod
+    async def request(cls, method: str, url: str, paced: bool = True, **kwargs) -> dict:
+        """
+        Make a request and return its JSON body, retrying throttled and failed requests
+        """
+        session = HttpClient.get()
+        for attempt in range(cls.max_retries + 1):
+            if paced:
+                await cls.wait_turn()
+            retry_after = None
+            try:
+                async with cls.slots:
+                    async with session.request(method, url, **kwargs) as res:
+                        if paced:
+                            cls.update(res.headers)
+                        if res.status != 429 and res.status < 500:
+                            res.raise_for_status()
+                            return await res.json()
+                        retry_after = res.headers.get("Retry-After")
+                        reason = f"status {res.status}"
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                reason = repr(exc)
+
+            if attempt < cls.max_retries:
+                delay = cls.backoff(attempt, retry_after)
+                logging.warning(
+                    "[reddit] %s %s failed (%s), retrying in %.1fs", method, url, reason, delay
+                )
+                await asyncio.sleep(delay)
+
+        raise RuntimeError(f"Reddit request to {url} failed after {cls.max_retries} retries")
+
+
+TOKEN_LIFETIME_S = 100 * 60
+TOKEN_REFRESH_MARGIN_S = CONFIG.getint("reddit", "token_refresh_margin_s")
+AUTH_LOCK = asyncio.Lock()
+
+
+async def set_auth(refresh: bool = False) -> None:
+    """
+    Get a new token if expired, or if refresh is set and it's close enough to expiring.
+    Concurrent callers share a single token request
+    """
+
+    def is_valid() -> bool:
+        margin = TOKEN_REFRESH_MARGIN_S if refresh else 0
+        return time.time() < REDDIT_CONF.auth_time + TOKEN_LIFETIME_S - margin
 
-async def set_auth(session: aiohttp.ClientSession) -> None:
     # Only auth if token is expired
-    if time.time() < REDDIT_CONF.auth_time + (100 * 60):
+    if is_valid():
         return
 
-    # note that CLIENT_ID refers to 'personal use script' and SECRET_TOKEN to 'token'
-    auth = aiohttp.BasicAuth(REDDIT_CONF.creds["client_id"], REDDIT_CONF.creds["secret"])
+    async with AUTH_LOCK:
+        # Another caller may have got a new token while we waited
+        if is_valid():
+            return
+
+        # note that CLIENT_ID refers to 'personal use script' and SECRET_TOKEN to 'token'
+        auth = aiohttp.BasicAuth(REDDIT_CONF.creds["client_id"], REDDIT_CONF.creds["secret"])
 
-    # here we pass our login method (password), username, and password
-    data = {
-        "grant_type": "password",
-        "username": REDDIT_CONF.creds["username"],
-        "password": REDDIT_CONF.creds["password"],
-    }
+        # here we pass our login method (password), username, and password
+        data = {
+            "grant_type": "password",
+            "username": REDDIT_CONF.creds["username"],
+            "password": REDDIT_CONF.creds["password"],
+        }
 
-    # setup our header info, which gives reddit a brief description of our app
-    headers = {"User-Agent": "botblue"}
+        # setup our header info, which gives reddit a brief description of our app
+        headers = {"User-Agent": "botblue"}
 
-    # send our request for an OAuth token
-    async with session.post(
-        "https://www.reddit.com/api/v1/access_token", auth=auth, data=data, headers=headers
-    ) as res:
-        # convert response to JSON and pull access_token value
-        token = (await res.json())["access_token"]
+        # send our request for an OAuth token, which has its own rate limit from the API's
+        resp = await RedditScheduler.request(
+            "POST",
+            "https://www.reddit.com/api/v1/access_token",
+            paced=False,
+            auth=auth,
+            data=data,
+            headers=headers,
+        )
+        token = resp["access_token"]
 
-    # add authorization to our headers dictionary
-    REDDIT_CONF.auth_headers = {**headers, **{"Authorization": f"bearer {token}"}}
-    REDDIT_CONF.auth_time = time.time()
+        # add authorization to our headers dictionary
+        REDDIT_CONF.auth_headers = {**headers, **{"Authorization": f"bearer {token}"}}
+        REDDIT_CONF.auth_time = time.time()
+        logging.info("[reddit] Got new auth token")
 
     # while the token is valid (~2 hours) we just add headers=headers to our requests
 
 
+async def keep_auth_fresh() -> None:
+    """
+    Refresh the token in the background before it expires, so requests never wait on it
+    """
+    while True:
+        try:
+            await set_auth(refresh=True)
+            refresh_at = REDDIT_CONF.auth_time + TOKEN_LIFETIME_S - TOKEN_REFRESH_MARGIN_S
+            await asyncio.sleep(max(1.0, refresh_at - time.time()))
+        except Exception:
+            logging.exception("[reddit] Failed to refresh auth token")
+            await asyncio.sleep(30)
+
+
 async def scrape_subreddit(
-    session: aiohttp.ClientSession,
     subreddit: str,
     time: str = "week",
     lim: int = 10,
@@ -86,12 +269,12 @@ async def scrape_subreddit(
     cat = "controversial" if controversial else "top"
 
     ##make the request
-    async with session.get(
+    results = await RedditScheduler.request(
+        "GET",
         f"https://oauth.reddit.com/r/{subreddit}/{cat}",
         headers=REDDIT_CONF.auth_headers,
         params=param_dict,
-    ) as res:
-        results = await res.json()
+    )
     # res objct contains listings data
     data = []
     ##iterate through top page of subreddit
@@ -106,6 +289,7 @@ async def scrape_subreddit(
                 ##if post is image, save title and image url
                 data.append(
                     {
+                        "id": post["id"],
                         "title": post["title"],
                         "url": post["url"],
                         "author": post["author"],
@@ -7,16 +7,32 @@
 import asyncio
 import json
 import logging
+import os
 import secrets
-from hashlib import md5
+import socket
+import time
 
-import cachetools
 import zmq
 import zmq.asyncio
-from redis import Redis, RedisError, ConnectionError
+from redis.asyncio import Redis
+from redis.exceptions import ConnectionError, RedisError
 
 from .config import CONFIG
-from .timing import Timer
+from .envelope import Envelope, new_job_id, pack, unpack
+from .inflight import InFlightJob, InFlightTable
+from .lanes import LANE_WEIGHTS, command_of, lane_for, lane_queue
+from .metrics import (
+    IN_FLIGHT,
+    INGRESS_TO_ENQUEUE,
+    JOB_TIME,
+    QUEUE_DEPTH,
+    REJECTED,
+    RESPONSE_WAIT,
+    TIMED_OUT,
+)
+from .profiling import PROFILE_CHANNEL, PROFILE_COMMAND, parse_request, start_profiling
+from .tracing import export_trace, stamp, start_trace
+from .transport import create_transport
 
 
 class Router:
@@ -24,17 +40,43 @@ class Router:
     Handle zmq interface
     """
 
-    def __init__(self) -> None:
-        self.__db = Redis(decode_responses=True)
+    def __init__(self, db: Redis) -> None:
+        self.__db = db
         self.in_queue = "job_queue"
-        self.out_queue = "response_queue"
-        self.job_cache: cachetools.TTLCache = cachetools.TTLCache(1000, 60)
+        self.transport = create_transport(db)
+        self.router_id = CONFIG.get("startup", "router_id") or default_router_id()
+        # Responses come back on a queue owned by this router, so routers can share Redis
+        self.out_queue = f"response_queue:{self.router_id}"
+        self.in_flight = InFlightTable(CONFIG.getfloat("admission", "timer_tick_s"))
+        self.response_timeout = CONFIG.getfloat("admission", "response_timeout_s")
+        self.block_timeout = CONFIG.getint("redis", "block_timeout_s")
+        self.max_batch = CONFIG.getint("startup", "max_recv_batch")
+        self.depth_log_interval = CONFIG.getint("startup", "queue_log_interval_s")
+        self.admin_token = ""
+        if CONFIG.getboolean("profiling", "admin_enabled"):
+            self.admin_token = CONFIG.get("profiling", "admin_token")
+        self.broadcast_admin = CONFIG.getint("startup", "num_processes") > 0
+
+        # Admission control
+        self.job_deadline = CONFIG.getfloat("admission", "job_deadline_s")
+        self.max_queue_depth = CONFIG.getint("admission", "max_queue_depth")
+        self.max_wait = CONFIG.getfloat("admission", "max_estimated_wait_s")
+        self.depth_poll_interval = CONFIG.getfloat("admission", "depth_poll_interval_s")
+        self.depths = {lane_queue(self.in_queue, lane): 0 for lane in LANE_WEIGHTS}
+        # Moving average of the time workers spend running a job, excluding queue wait,
+        # which the depth already accounts for
+        self.execution_time_ms = 0.0
+        self.capacity = (
+            max(1, CONFIG.getint("startup", "num_processes"))
+            * CONFIG.getint("startup", "num_workers")
+            * CONFIG.getint("startup", "worker_concurrency")
+        )
 
         ctx = zmq.asyncio.Context()
         self.__sck = ctx.socket(zmq.ROUTER)
         address = CONFIG.get("startup", "zmq_address")
         self.__sck.bind(address)
-        logging.info("Socket bound at %s", address)
+        logging.info("Socket bound at %s as router %s", address, self.router_id)
         self.__sck.setsockopt(zmq.RCVTIMEO, 500)
         self.__sck.setsockopt(zmq.LINGER, 1000)
 
@@ -43,33 +85,64 @@ class Router:
 
     async def recv(self) -> None:
         """
-        Poll for received commands until shutdown
+        Poll for received commands until shutdown, draining every message already
+        waiting on the socket each time it wakes up
         """
         while not self.is_shutting_down:
             try:
-                msg = await self.__sck.recv_multipart()
-                await self.put_in_queue(msg)
+                batch = [await self.__sck.recv_multipart()]
+                received = time.monotonic()
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(await self.__sck.recv_multipart(flags=zmq.NOBLOCK))
+                    except zmq.Again:
+                        break
+                await self.put_in_queue(batch, received)
             except zmq.Again:
                 pass
             except Exception as exc:
                 logging.exception(exc)
                 self.__sck.send_json({"code": 1})
-            finally:
-                await asyncio.sleep(0.01)
+                await asyncio.sleep(0.5)
 
-    async def put_in_queue(self, msg: list, max_attempts: int = 5) -> None:
+    async def put_in_queue(self, msgs: list[list], received: float, max_attempts: int = 5) -> None:
         """
-        Puts a message in the input queue
+        Puts a batch of messages in their lanes of the input queue in one Redis call,
+        turning away any that would push a lane over its limits
         """
+        now = time.time()
+        jobs: list[tuple[str, list, str]] = []
+        lanes: dict[str, list[bytes]] = {}
+        for msg in msgs:
+            command = command_of(msg[-1])
+            if not command and self.admin_token and await self.handle_admin(msg):
+                continue
+            queue = lane_queue(self.in_queue, lane_for(command))
+            depth = self.depths.get(queue, 0) + len(lanes.get(queue, []))
+            if not self.admit(depth):
+                await self.reject(msg)
+                continue
+            job_id = new_job_id(self.router_id)
+            jobs.append((job_id, msg, command))
+            trace = start_trace(received)
+            stamp(trace, "enqueue")
+            envelope = Envelope(
+                job_id, msg, deadline=now + self.job_deadline, timestamp=now, trace=trace
+            )
+            lanes.setdefault(queue, []).append(pack(envelope))
+        if not lanes:
+            return
+
+        # Register before pushing so a fast response can't arrive for an unknown ID
+        for job_id, msg, command in jobs:
+            self.in_flight.add(job_id, msg[:-1], command, self.response_timeout)
         for attempt in range(max_attempts):
             try:
-                job_id = md5(secrets.token_bytes(8)).hexdigest()
-                job = [job_id, *[x.hex() for x in msg]]
-                self.__db.rpush(self.in_queue, json.dumps(job))
-                self.__db.expire(self.in_queue, 60)
-                self.job_cache[job_id] = None  # store ID as dict for faster lookup
-                Timer.start(job_id)
-                logging.info("[router] Queued job: %s", job_id)
+                self.depths.update(await self.transport.push(lanes))
+                elapsed_ms = (time.monotonic() - received) * 1000
+                for job_id, _, command in jobs:
+                    INGRESS_TO_ENQUEUE.observe(elapsed_ms, command)
+                    logging.info("[router] Queued job: %s", job_id)
                 return
             except (RedisError, ConnectionError):
                 logging.exception(
@@ -79,36 +152,149 @@ class Router:
                 )
                 await asyncio.sleep(0.2)
 
+        for job_id, _, _ in jobs:
+            self.in_flight.pop(job_id)
         raise Exception(f"Redis connection failure, retried {max_attempts} times")
 
+    def admit(self, depth: int) -> bool:
+        """
+        Check a lane's queue depth and the wait it implies at the recent average execution time
+        """
+        estimated_wait = depth * self.execution_time_ms / 1000 / self.capacity
+        return depth < self.max_queue_depth and estimated_wait < self.max_wait
+
+    async def reject(self, msg: list) -> None:
+        logging.warning("[router] Queue over limits, rejected message")
+        REJECTED.inc()
+        response = {"code": 1, "error": {"msg": "Server busy, try again later", "trace": ""}}
+        await self.__sck.send_multipart([*msg[:-1], json.dumps(response).encode()])
+
+    async def handle_admin(self, msg: list) -> bool:
+        """
+        Handle the message if it is an admin command, which needs the configured token.
+        Profiling starts in this process and, over Redis pubsub, in every worker process
+        """
+        try:
+            request = json.loads(msg[-1])
+            if request.get("command") != PROFILE_COMMAND:
+                return False
+            params = dict(request.get("params") or {})
+        except (ValueError, AttributeError, TypeError):
+            return False
+
+        token = str(params.pop("token", ""))
+        if not secrets.compare_digest(token.encode(), self.admin_token.encode()):
+            logging.warning("[router] Rejected admin command with a bad token")
+            response = {"code": 1, "error": {"msg": "Not authorised", "trace": ""}}
+        else:
+            try:
+                mode, seconds, command = parse_request(params)
+                start_profiling(mode, seconds, command)
+                if self.broadcast_admin:
+                    await self.__db.publish(PROFILE_CHANNEL, json.dumps(params))
+                response = {"code": 0, "result": f"Started {mode} profiling for {seconds}s"}
+            except ValueError as exc:
+                response = {"code": 1, "error": {"msg": str(exc), "trace": ""}}
+            except (RedisError, ConnectionError):
+                logging.exception("[router] Failed to broadcast profiling request")
+                response = {"code": 1, "error": {"msg": "Failed to reach workers", "trace": ""}}
+        await self.__sck.send_multipart([*msg[:-1], json.dumps(response).encode()])
+        return True
+
+    async def monitor_queues(self) -> None:
+        """
+        Poll the depth of each lane of the input queue for admission control,
+        and periodically log them
+        """
+        queues = list(self.depths)
+        last_log = time.monotonic()
+        while not self.is_shutting_down:
+            await asyncio.sleep(self.depth_poll_interval)
+            try:
+                self.depths.update(zip(queues, await self.transport.depths(queues)))
+                response_depth = await self.__db.llen(self.out_queue)
+            except (RedisError, ConnectionError):
+                logging.exception("[router] Failed to read queue depths")
+                continue
+            for queue, depth in self.depths.items():
+                QUEUE_DEPTH.set(depth, queue)
+            QUEUE_DEPTH.set(response_depth, self.out_queue)
+            IN_FLIGHT.set(len(self.in_flight))
+            if time.monotonic() - last_log >= self.depth_log_interval:
+                last_log = time.monotonic()
+                logging.info(
+                    "[router] Queue depths: %s",
+                    ", ".join(f"{queue}={depth}" for queue, depth in self.depths.items()),
+                )
+
     async def send(self) -> None:
         """
         Check for completed jobs and send until shutdown
         """
         while not self.is_shutting_down:
             try:
-                work = self.get_from_queue()
+                work = await self.get_from_queue()
                 if work:
-                    job_id, msg = work
-                    await self.__sck.send_multipart(msg)
-                    logging.info("[router] Sent response, job took %sms", Timer.stop(job_id))
+                    envelope, job = work
+                    await self.__sck.send_multipart(envelope.frames)
+                    if envelope.is_partial:
+                        logging.info("[router] Sent partial response for job: %s", envelope.job_id)
+                    else:
+                        elapsed = job.elapsed_ms()
+                        if envelope.execution_time:
+                            self.execution_time_ms = (
+                                0.9 * self.execution_time_ms + 0.1 * envelope.execution_time * 1000
+                            )
+                        JOB_TIME.observe(elapsed, job.command)
+                        if envelope.timestamp:
+                            RESPONSE_WAIT.observe(
+                                (time.time() - envelope.timestamp) * 1000, job.command
+                            )
+                        logging.info("[router] Sent response, job took %sms", elapsed)
+                        if envelope.trace is not None:
+                            stamp(envelope.trace, "sent")
+                            export_trace(envelope.job_id, job.command, envelope.trace)
             except Exception as exc:
                 logging.exception(exc)
                 self.__sck.send_json({"code": 1})
-            finally:
-                await asyncio.sleep(0.01)
-
-    def get_from_queue(self) -> tuple[str, list] | None:
-        """
-        Get job ID and zmq message from Redis
-        """
-        msg = self.__db.lpop(self.out_queue)
-        if msg:
-            data = json.loads(msg)
-            job_id = data[0]
-            if job_id in self.job_cache:
-                response = [bytes.fromhex(x) for x in data[1:]]
-                del self.job_cache[job_id]
-                return job_id, response
-            logging.error("Job ID failed to validate. Fake job response?")
+                await asyncio.sleep(0.5)
+
+    async def get_from_queue(self) -> tuple[Envelope, InFlightJob] | None:
+        """
+        Block until a response is available in Redis or the timeout passes,
+        then get it with its in-flight job, which is done with unless the response is partial
+        """
+        popped = await self.__db.blpop([self.out_queue], self.block_timeout)
+        if popped:
+            _, msg = popped
+            envelope = unpack(msg)
+            stamp(envelope.trace, "received")
+            if envelope.is_partial:
+                job = self.in_flight.get(envelope.job_id)
+            else:
+                job = self.in_flight.pop(envelope.job_id)
+            if job:
+                return envelope, job
+            logging.error("Response for unknown or timed out job: %s", envelope.job_id)
         return None
+
+    async def expire_jobs(self) -> None:
+        """
+        Reply to clients whose jobs have had no response by their deadline
+        """
+        response = json.dumps(
+            {"code": 1, "error": {"msg": "Job timed out waiting for a response", "trace": ""}}
+        ).encode()
+        while not self.is_shutting_down:
+            await asyncio.sleep(self.in_flight.wheel.tick)
+            for job_id, job in self.in_flight.expire():
+                logging.warning("[router] Job timed out: %s", job_id)
+                TIMED_OUT.inc()
+                try:
+                    await self.__sck.send_multipart([*job.routing, response])
+                except zmq.ZMQError:
+                    logging.exception("[router] Failed to send timeout response")
+
+
+def default_router_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(2)}"
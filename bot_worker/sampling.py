@@ -0,0 +1,112 @@
+"""
+    discord-bot-2 backend
+
+    Score-weighted meme sampling index
+
+"""
+import random
+from bisect import bisect_right
+from collections import deque
+
+
+class MemeIndex:
+    """
+    Memes deduplicated by post ID and image URL across subreddits, sampled in O(log n) with
+    probability by score by bisecting cumulative weights. Anything served in the last
+    `exclude_recent` picks is skipped. New posts are appended without a rebuild, and posts
+    that drop out of the scrape are tombstoned until enough have built up to compact
+    """
+
+    max_attempts = 16
+    # Compact once this share of the weight is tombstoned, as samples landing on it are retried
+    max_removed_weight = 0.25
+
+    def __init__(self, exclude_recent: int) -> None:
+        self.posts: list[dict] = []
+        self.cumulative: list[float] = []
+        self.total = 0.0
+        self.keys: dict[str, int] = {}  # post ID or URL -> position in posts
+        self.removed: set[int] = set()
+        self.removed_weight = 0.0
+        self.recent: deque[int] = deque()
+        self.recent_set: set[int] = set()
+        self.exclude_recent = exclude_recent
+
+    def __len__(self) -> int:
+        return len(self.posts) - len(self.removed)
+
+    @staticmethod
+    def weight(post: dict) -> float:
+        return float(max(post["score"], 1))
+
+    def indexed_weight(self, pos: int) -> float:
+        return self.cumulative[pos] - (self.cumulative[pos - 1] if pos else 0.0)
+
+    def update(self, posts: list[dict]) -> None:
+        """
+        Add the posts of a new scrape, refreshing ones already indexed
+        and tombstoning any that weren't in it
+        """
+        seen = set()
+        for post in posts:
+            pos = self.keys.get(post["id"], self.keys.get(post["url"]))
+            if pos is None:
+                pos = len(self.posts)
+                self.posts.append(post)
+                self.total += self.weight(post)
+                self.cumulative.append(self.total)
+                self.keys[post["id"]] = self.keys[post["url"]] = pos
+            elif pos not in seen:
+                # Weight stays as first indexed until the next compaction
+                self.posts[pos] = post
+                if pos in self.removed:
+                    self.removed.discard(pos)
+                    self.removed_weight -= self.indexed_weight(pos)
+            seen.add(pos)
+
+        for pos in set(range(len(self.posts))) - seen - self.removed:
+            self.removed.add(pos)
+            self.removed_weight += self.indexed_weight(pos)
+        if (
+            len(self.removed) > len(self.posts) // 2
+            or self.removed_weight > self.total * self.max_removed_weight
+        ):
+            self.rebuild()
+
+    def rebuild(self) -> None:
+        """
+        Compact out tombstoned posts and recompute weights from current scores
+        """
+        live = [post for pos, post in enumerate(self.posts) if pos not in self.removed]
+        recent_keys = [self.posts[pos]["id"] for pos in self.recent]
+        self.posts, self.cumulative, self.total = [], [], 0.0
+        self.keys, self.removed, self.removed_weight = {}, set(), 0.0
+        self.recent.clear()
+        self.recent_set.clear()
+        self.update(live)
+        for key in recent_keys:
+            if key in self.keys:
+                self.mark_served(self.keys[key])
+
+    def mark_served(self, pos: int) -> None:
+        self.recent.append(pos)
+        self.recent_set.add(pos)
+        while len(self.recent) > self.exclude_recent:
+            self.recent_set.discard(self.recent.popleft())
+
+    def sample(self) -> dict | None:
+        if not len(self):
+            return None
+
+        pos = -1
+        for _ in range(self.max_attempts):
+            pos = bisect_right(self.cumulative, random.random() * self.total)
+            if pos not in self.removed and pos not in self.recent_set:
+                break
+        else:
+            # Pool too small or too stale to avoid repeats, settle for any live post
+            if pos in self.removed:
+                pos = random.choice([p for p in range(len(self.posts)) if p not in self.removed])
+
+        self.mark_served(pos)
+        return self.posts[pos]
@@ -6,11 +6,22 @@
 """
 import asyncio
 import logging
+import signal
 import time
 
-from .config import CONFIG, setup_logging
+from .autoscaler import Autoscaler, CoroutinePool
+from .commands import COMMAND_STATS
+from .config import CONFIG
+from .db import create_redis
 from .google_handler import GoogleHandler
+from .http_client import HttpClient
+from .logs import setup_logging
+from .metrics import serve_metrics
+from .reddit import MemePool, keep_auth_fresh
+from .profiling import handle_profile_signal, listen_for_profile_requests, monitor_loop_lag
 from .router import Router
+from .supervisor import WorkerSupervisor, max_processes
+from .tracing import setup_trace_export
 from .worker import Worker
 
 
@@ -21,24 +32,122 @@ async def heartbeat():
         if time.time() - start > heartbeat_interval:
             start = time.time()
             logging.info("[main] HEARTBEAT")
+            if GoogleHandler.cache:
+                logging.info("[main] TTS cache stats: %s", GoogleHandler.cache.stats)
+            logging.info("[main] Command cache stats: %s", COMMAND_STATS)
         await asyncio.sleep(5)
 
 
 async def run_server():
     """
     Main running loop
+    Workers run as coroutines here, or in separate processes if num_processes is set
     """
     setup_logging()
+    setup_trace_export()
     num_workers = CONFIG.getint("startup", "num_workers")
-    GoogleHandler.initialise()
-    router = Router()
+    num_processes = CONFIG.getint("startup", "num_processes")
+    db = create_redis()
+    await HttpClient.start()
+    router = Router(db)
     logging.info("Starting server")
 
+    autoscaling = CONFIG.getboolean("autoscaling", "enabled")
+    concurrency = CONFIG.getint("startup", "worker_concurrency")
+    if num_processes > 0:
+        supervisor = WorkerSupervisor(worker_process_main, num_processes, (router.router_id,))
+        workers = [supervisor.run()]
+        if autoscaling:
+            autoscaler = Autoscaler(router, db, supervisor, num_workers * concurrency)
+            supervisor.num_processes = autoscaler.clamp(num_processes)
+            autoscaler.update_capacity(supervisor.num_processes)
+            workers.append(autoscaler.run())
+    else:
+        GoogleHandler.initialise()
+        workers = [MemePool.run(), keep_auth_fresh()]
+        if autoscaling:
+            pool = CoroutinePool(db, router.router_id)
+            autoscaler = Autoscaler(router, db, pool, concurrency)
+            for _ in range(autoscaler.clamp(num_workers)):
+                pool.add()
+            autoscaler.update_capacity(pool.size)
+            workers.append(autoscaler.run())
+        else:
+            workers.extend(Worker(str(i), db).run() for i in range(num_workers))
+
     futures = [
-        *[Worker(i).run() for i in range(num_workers)],
+        *workers,
         router.recv(),
         router.send(),
+        router.monitor_queues(),
+        router.expire_jobs(),
         heartbeat(),
     ]
+    if CONFIG.getboolean("metrics", "enabled"):
+        futures.append(serve_metrics())
+    if CONFIG.getboolean("profiling", "enabled"):
+        handle_profile_signal()
+        futures.append(monitor_loop_lag())
+
+    try:
+        await asyncio.gather(*futures)
+    finally:
+        await HttpClient.close()
+        await db.connection_pool.disconnect()
+
+
+async def run_worker_process(index: int, stats_scope: str = ""):
+    """
+    Running loop of a single worker process
+    """
+    setup_logging()
+    num_workers = CONFIG.getint("startup", "num_workers")
+    GoogleHandler.initialise(index, max_processes())
+    db = create_redis()
+    await HttpClient.start()
+    logging.info("Starting worker process %s", index)
+
+    workers = [Worker(f"{index}.{i}", db, stats_scope) for i in range(num_workers)]
+
+    def retire() -> None:
+        logging.info("Worker process %s retiring", index)
+        for worker in workers:
+            worker.is_shutting_down = True
 
-    await asyncio.gather(*futures)
+    # The supervisor retires a process with SIGTERM, its workers finish their jobs first
+    if hasattr(signal, "SIGTERM"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, retire)
+
+    futures = [
+        MemePool.run(),
+        keep_auth_fresh(),
+        heartbeat(),
+    ]
+    if CONFIG.getboolean("metrics", "enabled"):
+        # The router process serves on the configured port itself
+        futures.append(serve_metrics(index + 1))
+    if CONFIG.getboolean("profiling", "enabled"):
+        handle_profile_signal()
+        futures.append(monitor_loop_lag())
+    if CONFIG.getboolean("profiling", "admin_enabled"):
+        futures.append(listen_for_profile_requests(db))
+
+    background = [asyncio.create_task(future) for future in futures]
+    try:
+        await asyncio.gather(*[worker.run() for worker in workers])
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await HttpClient.close()
+        await db.connection_pool.disconnect()
+
+
+def worker_process_main(index: int, stats_scope: str = ""):
+    """
+    Entry point of a worker process started by the supervisor
+    """
+    try:
+        asyncio.run(run_worker_process(index, stats_scope))
+    except KeyboardInterrupt:
+        pass
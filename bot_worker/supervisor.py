@@ -0,0 +1,115 @@
+"""
+    discord-bot-2 backend
+
+    Worker process supervisor
+
+"""
+import asyncio
+import logging
+import multiprocessing
+import time
+from multiprocessing.process import BaseProcess
+from typing import Callable
+
+from .config import CONFIG
+
+
+def max_processes() -> int:
+    """
+    Most worker processes that can be running at once
+    """
+    if CONFIG.getboolean("autoscaling", "enabled"):
+        return CONFIG.getint("autoscaling", "max_workers")
+    return CONFIG.getint("startup", "num_processes")
+
+
+class WorkerSupervisor:
+    """
+    Starts worker processes, each running its own event loop and Worker coroutines,
+    and restarts any process that exits
+    """
+
+    def __init__(self, target: Callable[..., None], num_processes: int, args: tuple = ()) -> None:
+        # spawn so children don't inherit the parent's event loop, zmq context or Redis pool
+        self.ctx = multiprocessing.get_context("spawn")
+        self.target = target
+        self.args = args  # passed to the target after the process index
+        self.num_processes = num_processes
+        self.processes: dict[int, BaseProcess] = {}
+        self.retiring: list[BaseProcess] = []
+        self.started_at: dict[int, float] = {}
+        self.check_interval = 1.0
+        self.min_restart_interval = 5.0
+        self.is_shutting_down = False
+
+    def start_process(self, index: int) -> None:
+        proc = self.ctx.Process(
+            target=self.target, args=(index, *self.args), name=f"bot-worker-{index}", daemon=True
+        )
+        proc.start()
+        self.processes[index] = proc
+        self.started_at[index] = time.monotonic()
+        logging.info("[supervisor] Started worker process %s (pid %s)", index, proc.pid)
+
+    @property
+    def size(self) -> int:
+        return len(self.processes)
+
+    def add(self) -> None:
+        """
+        Start one more process at the lowest free index
+        """
+        index = next(i for i in range(len(self.processes) + 1) if i not in self.processes)
+        self.start_process(index)
+
+    def retire(self) -> None:
+        """
+        Ask the highest numbered process to exit once its workers finish their current jobs
+        """
+        index = max(self.processes)
+        proc = self.processes.pop(index)
+        del self.started_at[index]
+        # SIGTERM, which worker processes handle by shutting down their workers
+        proc.terminate()
+        self.retiring.append(proc)
+        logging.info("[supervisor] Retiring worker process %s (pid %s)", index, proc.pid)
+
+    async def run(self) -> None:
+        """
+        Start all processes then watch them until shutdown
+        """
+        for index in range(self.num_processes):
+            self.start_process(index)
+
+        try:
+            while not self.is_shutting_down:
+                await asyncio.sleep(self.check_interval)
+                for proc in [proc for proc in self.retiring if not proc.is_alive()]:
+                    logging.info("[supervisor] Worker process (pid %s) retired", proc.pid)
+                    self.retiring.remove(proc)
+                    proc.close()
+                for index, proc in list(self.processes.items()):
+                    if proc.is_alive():
+                        continue
+                    # Don't spin if a process dies straight away on startup
+                    if time.monotonic() - self.started_at[index] < self.min_restart_interval:
+                        continue
+                    logging.error(
+                        "[supervisor] Worker process %s (pid %s) exited with code %s, restarting",
+                        index,
+                        proc.pid,
+                        proc.exitcode,
+                    )
+                    proc.close()
+                    self.start_process(index)
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        processes = [*self.processes.values(), *self.retiring]
+        for proc in processes:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in processes:
+            proc.join(timeout=5)
+        logging.info("[supervisor] Stopped worker processes")
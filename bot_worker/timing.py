@@ -8,44 +8,33 @@ import functools
 import logging
 import time
 from inspect import iscoroutinefunction
-from typing import Optional
-
-import cachetools
 
 
 NS_IN_MS = 1000000
 
 
-class Timer:
-    timers: cachetools.TTLCache = cachetools.TTLCache(1000, 60)
-
-    @classmethod
-    def start(cls, key: str) -> None:
-        cls.timers[key] = time.time_ns()
-
-    @classmethod
-    def stop(cls, key: str) -> Optional[float]:
-        if key in cls.timers:
-            elapsed_ns = time.time_ns() - cls.timers[key]
-            del cls.timers[key]
-            return elapsed_ns / NS_IN_MS
-        return None
-
-
 def timeit(func):
+    """
+    Log how long each call of a function or coroutine function takes, passing its result through
+    """
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start = time.time_ns()
-        func(*args, **kwargs)
-        elapsed_ns = time.time_ns() - start
-        logging.info("%s took %fms", func.__name__, elapsed_ns / NS_IN_MS)
+        start = time.perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed_ns = time.perf_counter_ns() - start
+            logging.info("%s took %fms", func.__name__, elapsed_ns / NS_IN_MS)
 
     @functools.wraps(func)
     async def async_wrapper(*args, **kwargs):
-        start = time.time_ns()
-        await func(*args, **kwargs)
-        elapsed_ns = time.time_ns() - start
-        logging.info("%s took %fms", func.__name__, elapsed_ns / NS_IN_MS)
+        start = time.perf_counter_ns()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            elapsed_ns = time.perf_counter_ns() - start
+            logging.info("%s took %fms", func.__name__, elapsed_ns / NS_IN_MS)
 
     if iscoroutinefunction(func):
         return async_wrapper
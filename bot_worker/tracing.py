@@ -0,0 +1,96 @@
+"""
+    discord-bot-2 backend
+
+    Sampled end-to-end job traces exported as Chrome trace events
+
+"""
+import json
+import logging
+import os
+import random
+import time
+from logging.handlers import RotatingFileHandler
+
+from .config import CONFIG
+from .logs import start_writer
+
+SAMPLE_RATE = CONFIG.getfloat("tracing", "sample_rate")
+
+# Span names, keyed by the stage that ends them
+SPANS = {
+    "enqueue": "ingress",
+    "start": "queue_wait",
+    "validated": "validate",
+    "executed": "execute",
+    "put": "respond",
+    "received": "response_queue",
+    "sent": "send",
+}
+
+TRACE_LOGGER = logging.getLogger("bot_worker.traces")
+
+
+def start_trace(received: float) -> list[list] | None:
+    """
+    Start a trace for a job received at monotonic time `received` if it is sampled.
+    A single comparison when sampling is off
+    """
+    if SAMPLE_RATE and random.random() < SAMPLE_RATE:
+        return [["recv", received, os.getpid(), "router"]]
+    return None
+
+
+def stamp(trace: list[list] | None, stage: str, worker: str = "router") -> None:
+    """
+    Record that a traced job reached a stage, doing nothing if it is not traced
+    """
+    if trace is not None:
+        trace.append([stage, time.monotonic(), os.getpid(), worker])
+
+
+def setup_trace_export() -> None:
+    """
+    Write finished traces, one Chrome trace event per line, to a rotating file from the log
+    writer thread. `jq -s . traces.jsonl` turns a file into a trace viewable in Perfetto
+    or chrome://tracing
+    """
+    if not SAMPLE_RATE:
+        return
+    target = RotatingFileHandler(
+        CONFIG.get("tracing", "trace_file"),
+        maxBytes=CONFIG.getint("tracing", "max_file_mb") * 1024 * 1024,
+        backupCount=CONFIG.getint("tracing", "backup_count"),
+    )
+    target.setFormatter(logging.Formatter("%(message)s"))
+    TRACE_LOGGER.addHandler(start_writer(target))
+    TRACE_LOGGER.setLevel(logging.INFO)
+    TRACE_LOGGER.propagate = False
+
+
+def export_trace(job_id: str, command: str, trace: list[list]) -> None:
+    """
+    Write the span between each pair of consecutive stages plus one for the whole job.
+    Stage times are monotonic, so spans line up when the router and workers share a host
+    """
+    for (_, start, _, _), (stage, end, pid, worker) in zip(trace, trace[1:]):
+        name = SPANS.get(stage, stage)
+        if name == "execute":
+            name = f"execute:{command}"
+        write_event(name, start, end, pid, worker, job_id)
+
+    _, start, pid, worker = trace[0]
+    write_event(f"job:{command}", start, trace[-1][1], pid, worker, job_id)
+
+
+def write_event(name: str, start: float, end: float, pid: int, worker: str, job_id: str) -> None:
+    event = {
+        "name": name,
+        "cat": "job",
+        "ph": "X",
+        "ts": round(start * 1e6),
+        "dur": round((end - start) * 1e6),
+        "pid": pid,
+        "tid": worker,
+        "args": {"job_id": job_id},
+    }
+    TRACE_LOGGER.info(json.dumps(event, separators=(",", ":")))
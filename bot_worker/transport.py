@@ -0,0 +1,215 @@
+"""
+    discord-bot-2 backend
+
+    Job queue transports over Redis lists or Redis Streams
+
+"""
+import logging
+import os
+import socket
+from dataclasses import dataclass
+
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+from .config import CONFIG
+
+
+@dataclass
+class Job:
+    """
+    A packed job envelope, plus the stream and entry ID to acknowledge if it came from a stream
+    """
+
+    data: bytes
+    stream: str = ""
+    entry_id: bytes = b""
+
+
+class ListTransport:
+    """
+    Jobs are pushed onto and popped off Redis lists. A job is gone from Redis once popped,
+    so a worker that dies mid-job loses it
+    """
+
+    def __init__(self, db: Redis) -> None:
+        self.db = db
+
+    async def push(self, queues: dict[str, list[bytes]]) -> dict[str, int]:
+        """
+        Push jobs and return the depth of each queue after
+        """
+        pipe = self.db.pipeline()
+        for queue, jobs in queues.items():
+            pipe.rpush(queue, *jobs)
+        return dict(zip(queues, await pipe.execute()))
+
+    async def pop(self, queues: list[str], consumer: str, timeout: int) -> list[Job]:
+        """
+        Block until a job is in any of the queues, trying them in the order given
+        """
+        popped = await self.db.blpop(queues, timeout)
+        if popped:
+            return [Job(popped[1])]
+        return []
+
+    async def ack(self, job: Job) -> None:
+        """
+        Nothing to do, popping already removed the job
+        """
+
+    async def reclaim(self, queues: list[str], consumer: str, count: int = 10) -> list[Job]:
+        return []
+
+    async def depths(self, queues: list[str]) -> list[int]:
+        pipe = self.db.pipeline()
+        for queue in queues:
+            pipe.llen(queue)
+        return await pipe.execute()
+
+
+class StreamTransport:
+    """
+    Jobs are added to Redis Streams and read through a consumer group. A job stays pending
+    until acknowledged after its response is put, and jobs left pending for longer than
+    claim_idle_s are claimed by another worker. Jobs delivered more than max_retries times
+    are moved to a dead-letter stream instead
+    """
+
+    group = "workers"
+
+    def __init__(self, db: Redis) -> None:
+        self.db = db
+        self.maxlen = CONFIG.getint("queue", "stream_maxlen")
+        self.claim_idle_ms = CONFIG.getint("queue", "claim_idle_s") * 1000
+        self.max_retries = CONFIG.getint("queue", "max_retries")
+        self.groups_created: set[str] = set()
+
+    async def ensure_groups(self, streams: list[str]) -> None:
+        for stream in streams:
+            if stream in self.groups_created:
+                continue
+            try:
+                await self.db.xgroup_create(stream, self.group, id="0", mkstream=True)
+            except ResponseError as exc:
+                if "BUSYGROUP" not in str(exc):
+                    raise
+            self.groups_created.add(stream)
+
+    async def push(self, queues: dict[str, list[bytes]]) -> dict[str, int]:
+        """
+        Add jobs and return the length of each stream after
+        """
+        await self.ensure_groups(list(queues))
+        pipe = self.db.pipeline()
+        for stream, jobs in queues.items():
+            for job in jobs:
+                pipe.xadd(stream, {"job": job}, maxlen=self.maxlen, approximate=True)
+            pipe.xlen(stream)
+        results = iter(await pipe.execute())
+        depths = {}
+        for stream, jobs in queues.items():
+            for _ in jobs:
+                next(results)
+            depths[stream] = next(results)
+        return depths
+
+    async def pop(self, queues: list[str], consumer: str, timeout: int) -> list[Job]:
+        """
+        Take the first new entry from the streams in the order given, like BLPOP does,
+        else block until an entry arrives in any of them. Entries that arrive in more than
+        one stream at once are all returned, still in the order given
+        """
+        await self.ensure_groups(queues)
+        for stream in queues:
+            jobs = await self.read(consumer, [stream])
+            if jobs:
+                return jobs
+
+        jobs = await self.read(consumer, queues, block=timeout * 1000)
+        return sorted(jobs, key=lambda job: queues.index(job.stream))
+
+    async def read(self, consumer: str, streams: list[str], block: int | None = None) -> list[Job]:
+        read = await self.db.xreadgroup(
+            self.group, consumer, {stream: ">" for stream in streams}, count=1, block=block
+        )
+        return [
+            Job(fields[b"job"], stream.decode(), entry_id)
+            for stream, entries in read or []
+            for entry_id, fields in entries
+        ]
+
+    async def ack(self, job: Job) -> None:
+        pipe = self.db.pipeline()
+        pipe.xack(job.stream, self.group, job.entry_id)
+        pipe.xdel(job.stream, job.entry_id)
+        await pipe.execute()
+
+    async def reclaim(self, queues: list[str], consumer: str, count: int = 10) -> list[Job]:
+        """
+        Claim jobs left pending too long by a dead or stuck worker,
+        dead-lettering the ones that have run out of retries
+        """
+        await self.ensure_groups(queues)
+        jobs = []
+        for stream in queues:
+            pending = await self.db.xpending_range(
+                stream, self.group, min="-", max="+", count=count, idle=self.claim_idle_ms
+            )
+            retry, dead = [], []
+            for entry in pending:
+                if entry["times_delivered"] > self.max_retries:
+                    dead.append(entry["message_id"])
+                else:
+                    retry.append(entry["message_id"])
+
+            for entry_id in dead:
+                await self.dead_letter(stream, entry_id)
+
+            if retry:
+                claimed = await self.db.xclaim(
+                    stream, self.group, consumer, self.claim_idle_ms, retry
+                )
+                for entry_id, fields in claimed:
+                    # entries deleted since they were read come back empty
+                    if fields:
+                        jobs.append(Job(fields[b"job"], stream, entry_id))
+                logging.warning("[%s] Reclaimed %s jobs from %s", consumer, len(claimed), stream)
+        return jobs
+
+    async def dead_letter(self, stream: str, entry_id: bytes) -> None:
+        entries = await self.db.xrange(stream, min=entry_id, max=entry_id)
+        pipe = self.db.pipeline()
+        for _, fields in entries:
+            pipe.xadd(f"{stream}:dead", {**fields, b"entry_id": entry_id}, maxlen=self.maxlen)
+        pipe.xack(stream, self.group, entry_id)
+        pipe.xdel(stream, entry_id)
+        await pipe.execute()
+        logging.error(
+            "Job %s in %s ran out of retries, moved to dead-letter stream", entry_id, stream
+        )
+
+    async def depths(self, queues: list[str]) -> list[int]:
+        """
+        Entries are deleted once acknowledged, so this counts waiting and in-flight jobs
+        """
+        pipe = self.db.pipeline()
+        for stream in queues:
+            pipe.xlen(stream)
+        return await pipe.execute()
+
+
+Transport = ListTransport | StreamTransport
+
+
+def create_transport(db: Redis) -> Transport:
+    kind = CONFIG.get("queue", "transport")
+    if kind == "stream":
+        return StreamTransport(db)
+    if kind == "list":
+        return ListTransport(db)
+    raise ValueError(f"Unknown queue transport: {kind}")
+
+
+def consumer_name(wid: str) -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{wid}"
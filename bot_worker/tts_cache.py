@@ -0,0 +1,161 @@
+"""
+    discord-bot-2 backend
+
+    Two-tier cache of synthesized TTS audio
+
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+
+from google.cloud import texttospeech
+
+from .metrics import TTS_CACHE
+
+
+class AudioCache:
+    """
+    Synthesized audio keyed by a hash of the text and voice settings,
+    held in a memory LRU bounded by bytes in front of an on-disk store bounded by bytes
+    """
+
+    def __init__(self, directory: str, memory_bytes: int, disk_bytes: int) -> None:
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory: OrderedDict[str, bytes] = OrderedDict()
+        self.memory_used = 0
+        self.disk: OrderedDict[str, int] = OrderedDict()  # key -> file size
+        self.disk_used = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.load_disk_index()
+
+    @staticmethod
+    def key(
+        text: str, voice: texttospeech.VoiceSelectionParams, audio_config: texttospeech.AudioConfig
+    ) -> str:
+        settings = [
+            text,
+            voice.language_code,
+            voice.name,
+            audio_config.pitch,
+            audio_config.speaking_rate,
+            int(audio_config.audio_encoding),
+        ]
+        return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def load_disk_index(self) -> None:
+        """
+        Index existing files from least to most recently used
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".mp3"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_used += size
+        # At startup, before the loop is busy
+        self._remove(self.evict_disk())
+
+    async def get(self, key: str) -> bytes | None:
+        """
+        Look the key up in memory on the loop, reading from disk in a thread if needed
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            TTS_CACHE.inc("memory")
+            return self.memory[key]
+
+        if key in self.disk:
+            try:
+                audio = await asyncio.to_thread(self._read, self.path(key))
+            except OSError:
+                if key in self.disk:
+                    self.forget_disk(key)
+            else:
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+                self.stats["disk_hits"] += 1
+                TTS_CACHE.inc("disk")
+                self.put_memory(key, audio)
+                return audio
+
+        self.stats["misses"] += 1
+        TTS_CACHE.inc("miss")
+        return None
+
+    async def put(self, key: str, audio: bytes) -> None:
+        """
+        Store in memory on the loop and on disk in a thread. The disk index is only
+        changed on the loop, so it needs no lock
+        """
+        self.put_memory(key, audio)
+        if key in self.disk or len(audio) > self.disk_bytes:
+            return
+        try:
+            await asyncio.to_thread(self._write, self.path(key), audio)
+        except OSError:
+            logging.exception("Failed to write TTS cache file")
+            return
+        if key in self.disk:
+            return
+        self.disk[key] = len(audio)
+        self.disk_used += len(audio)
+        evicted = self.evict_disk()
+        if evicted:
+            await asyncio.to_thread(self._remove, evicted)
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        with open(path, "rb") as file:
+            return file.read()
+
+    @staticmethod
+    def _write(path: str, audio: bytes) -> None:
+        # Write then rename so other worker processes never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(audio)
+        os.replace(tmp_path, path)
+
+    def put_memory(self, key: str, audio: bytes) -> None:
+        if key in self.memory or len(audio) > self.memory_bytes:
+            return
+        self.memory[key] = audio
+        self.memory_used += len(audio)
+        while self.memory_used > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= len(evicted)
+
+    def evict_disk(self) -> list[str]:
+        """
+        Drop the least recently used files from the index until under the limit,
+        returning their paths to remove
+        """
+        evicted = []
+        while self.disk_used > self.disk_bytes:
+            key = next(iter(self.disk))
+            self.forget_disk(key)
+            evicted.append(self.path(key))
+        return evicted
+
+    @staticmethod
+    def _remove(paths: list[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def forget_disk(self, key: str) -> None:
+        self.disk_used -= self.disk.pop(key)
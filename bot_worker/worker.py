@@ -7,11 +7,20 @@
 import asyncio
 import json
 import logging
+import time
+from functools import partial
 
-from redis import Redis, RedisError, ConnectionError
+from redis.asyncio import Redis
+from redis.exceptions import ConnectionError, RedisError
 
-from .commands import API_COMMANDS, handle_command
+from .commands import API_COMMANDS, PARTIAL_PUBLISHER, handle_command
+from .config import CONFIG
+from .envelope import FLAG_PARTIAL, Envelope, origin_of, pack, unpack
 from .exceptions import MessageInvalidError
+from .lanes import LaneScheduler, lane_queue
+from .metrics import EXECUTION, QUEUE_WAIT, WORKER_UTILIZATION
+from .tracing import stamp
+from .transport import Job, consumer_name, create_transport
 
 
 class Worker:
@@ -20,15 +29,30 @@ class Worker:
     Puts results into response queue
     """
 
-    def __init__(self, worker_id: int) -> None:
+    def __init__(self, worker_id: str, db: Redis, stats_scope: str = "") -> None:
         self.__wid = f"worker:{worker_id}"
-        self.__db = Redis(decode_responses=True)
+        self.__db = db
         self.in_queue = "job_queue"
+        self.transport = create_transport(db)
+        self.consumer = consumer_name(self.__wid)
+        self.reclaim_interval = CONFIG.getint("queue", "reclaim_interval_s")
+        self.next_reclaim = 0.0
+        self.scheduler = LaneScheduler()
         self.out_queue = "response_queue"
         self.client_map = "client_map"
+        self.block_timeout = CONFIG.getint("redis", "block_timeout_s")
         self.is_shutting_down = False
-        self.msg_len = 3
-        self.work: bytes = b""
+        self.concurrency = CONFIG.getint("startup", "worker_concurrency")
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.busy = 0
+        self.tasks: set[asyncio.Task] = set()
+        # Load reported for the autoscaler
+        # Scoped to the router whose autoscaler runs this worker
+        self.stats_key = f"worker_stats:{stats_scope}:{self.__wid}"
+        self.stats_interval = CONFIG.getfloat("autoscaling", "stats_interval_s")
+        self.report = CONFIG.getboolean("autoscaling", "enabled")
+        self.wait_total_ms = 0.0
+        self.wait_count = 0
 
     @property
     def wid(self):
@@ -36,61 +60,185 @@ class Worker:
 
     async def run(self) -> None:
         """
-        Try to process jobs from queue until shutdown
+        Try to process jobs from queue until shutdown,
+        keeping up to `concurrency` jobs in flight at once
         """
         logging.info("%s started", self.wid)
+        reporter = asyncio.create_task(self.report_stats()) if self.report else None
         while not self.is_shutting_down:
+            await self.slots.acquire()
+            if self.is_shutting_down:
+                # Retired while waiting for a slot
+                self.slots.release()
+                break
             try:
-                work = self.get_work()
-                if work:
-                    job_id, client, msg = work
-                    validate_msg(msg)
-                    response = await handle_command(*msg.values())
-                    await self.put_response(job_id, client, response)
-                    logging.info("[%s] Completed job: %s", self.__wid, job_id)
-                await asyncio.sleep(0.01)
+                jobs = await self.get_work()
             except Exception as exc:
-                logging.exception("[%s] An error occurred processing job: %s", self.__wid, exc)
-                logging.info("The message that caused the error: %s", self.work)
+                self.slots.release()
+                logging.exception("[%s] An error occurred getting job: %s", self.__wid, exc)
                 await asyncio.sleep(0.5)
+                continue
 
-    def get_work(self) -> tuple[str, bytes, dict] | None:
-        """Grab work from redis queue"""
-        msg = self.__db.lpop(self.in_queue)
-        if msg:
-            job = json.loads(msg)
-            self.msg_len = len(job)
-
-            if self.msg_len == 4:
-                client, _, self.work = [bytes.fromhex(x) for x in job[1:]]
-                return job[0], client, json.loads(self.work)
-            elif self.msg_len == 3:
-                client, self.work = [bytes.fromhex(x) for x in job[1:]]
-                return job[0], client, json.loads(self.work)
-            else:
+            if not jobs:
+                self.slots.release()
+                continue
+
+            for i, job in enumerate(jobs):
+                # The first job takes the slot acquired above
+                if i > 0:
+                    await self.slots.acquire()
+                task = asyncio.create_task(self.process(job))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+        # Retired or shutting down, finish the jobs already taken
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        if reporter:
+            await reporter
+        logging.info("%s stopped", self.wid)
+
+    async def report_stats(self) -> None:
+        """
+        Put this worker's slot use and mean queue wait in Redis every stats interval
+        until shutdown, expiring so a dead worker drops out
+        """
+        while not self.is_shutting_down:
+            stats = {
+                "busy": self.busy,
+                "concurrency": self.concurrency,
+                "queue_wait_ms": self.wait_total_ms / self.wait_count if self.wait_count else 0.0,
+            }
+            self.wait_total_ms, self.wait_count = 0.0, 0
+            try:
+                await self.__db.set(
+                    self.stats_key, json.dumps(stats), ex=max(1, round(self.stats_interval * 3))
+                )
+            except (RedisError, ConnectionError):
+                logging.exception("[%s] Failed to report stats", self.__wid)
+            await asyncio.sleep(self.stats_interval)
+
+        try:
+            await self.__db.delete(self.stats_key)
+        except (RedisError, ConnectionError):
+            logging.exception("[%s] Failed to clear stats", self.__wid)
+
+    async def process(self, job: Job) -> None:
+        """
+        Run a single job and put its response, freeing a slot when done.
+        The job is acknowledged unless putting the response failed, so it can be retried
+        """
+        ack = True
+        payload = b""
+        self.busy += 1
+        WORKER_UTILIZATION.set(self.busy / self.concurrency, self.__wid)
+        try:
+            envelope = unpack(job.data)
+            stamp(envelope.trace, "start", self.__wid)
+            # client identity, optional empty delimiter, then the payload
+            if len(envelope.frames) not in (2, 3):
                 raise MessageInvalidError("Message malformed")
+            payload = envelope.payload
+            execution_time = 0.0
 
-        return None
+            if envelope.is_expired(time.time()):
+                # The client has likely given up, don't waste time running it
+                logging.warning("[%s] Skipped expired job: %s", self.__wid, envelope.job_id)
+                response = {"code": 1, "error": {"msg": "Job expired in queue", "trace": ""}}
+            else:
+                msg = json.loads(payload)
+                validate_msg(msg)
+                stamp(envelope.trace, "validated", self.__wid)
+                if envelope.timestamp:
+                    queue_wait_ms = (time.time() - envelope.timestamp) * 1000
+                    QUEUE_WAIT.observe(queue_wait_ms, msg["command"])
+                    self.wait_total_ms += queue_wait_ms
+                    self.wait_count += 1
+                PARTIAL_PUBLISHER.set(
+                    partial(self.put_partial_response, envelope.job_id, envelope.routing)
+                )
+                start = time.perf_counter()
+                response = await handle_command(*msg.values())
+                execution_time = time.perf_counter() - start
+                EXECUTION.observe(execution_time * 1000, msg["command"])
+                stamp(envelope.trace, "executed", self.__wid)
+
+            ack = False
+            await self.put_response(
+                envelope.job_id,
+                envelope.routing,
+                response,
+                trace=envelope.trace,
+                execution_time=execution_time,
+            )
+            ack = True
+            logging.info("[%s] Completed job: %s", self.__wid, envelope.job_id)
+        except Exception as exc:
+            logging.exception("[%s] An error occurred processing job: %s", self.__wid, exc)
+            # Cut down, as a say_test payload can be large
+            logging.info("The message that caused the error: %s", payload[:1000])
+        finally:
+            try:
+                if ack:
+                    await self.transport.ack(job)
+            except (RedisError, ConnectionError):
+                logging.exception("[%s] Failed to acknowledge job", self.__wid)
+            self.busy -= 1
+            WORKER_UTILIZATION.set(self.busy / self.concurrency, self.__wid)
+            self.slots.release()
+
+    async def get_work(self) -> list[Job]:
+        """
+        Block until work is available in any lane of the job queue or the timeout passes,
+        so that the shutdown flag is still checked regularly.
+        Jobs abandoned by other workers are reclaimed first when due
+        """
+        lanes = [lane_queue(self.in_queue, lane) for lane in self.scheduler.order()]
+        if time.monotonic() >= self.next_reclaim:
+            self.next_reclaim = time.monotonic() + self.reclaim_interval
+            jobs = await self.transport.reclaim(lanes, self.consumer)
+            if jobs:
+                return jobs
+
+        return await self.transport.pop(lanes, self.consumer, self.block_timeout)
+
+    async def put_partial_response(self, job_id: str, routing: list[bytes], result: object) -> None:
+        """Put an early part of a job's result, ahead of its final response"""
+        response = {"code": 0, "partial": True, "result": result}
+        await self.put_response(job_id, routing, response, flags=FLAG_PARTIAL)
 
     async def put_response(
         self,
         job_id: str,
-        client: bytes,
+        routing: list[bytes],
         response: dict,
         max_attempts=5,
+        flags: int = 0,
+        trace: list[list] | None = None,
+        execution_time: float = 0.0,
     ) -> None:
-        """Put response in redis queue"""
+        """
+        Put response in the queue of the router the job came from,
+        with the time spent running the job and its trace if it is traced
+        """
+        stamp(trace, "put", self.__wid)
+        msg = pack(
+            Envelope(
+                job_id,
+                [*routing, json.dumps(response).encode()],
+                flags,
+                timestamp=time.time(),
+                execution_time=execution_time,
+                trace=trace,
+            )
+        )
+        out_queue = f"{self.out_queue}:{origin_of(job_id)}"
         for attempt in range(max_attempts):
             try:
-                msg = None
-                if self.msg_len == 4:
-                    msg = [job_id, client.hex(), "", json.dumps(response).encode().hex()]
-
-                if self.msg_len == 3:
-                    msg = [job_id, client.hex(), json.dumps(response).encode().hex()]
-
-                self.__db.rpush(self.out_queue, json.dumps(msg))
-                self.__db.expire(self.out_queue, 60)
+                pipe = self.__db.pipeline()
+                pipe.rpush(out_queue, msg)
+                pipe.expire(out_queue, 60)
+                await pipe.execute()
                 return
             except (RedisError, ConnectionError):
                 logging.exception(
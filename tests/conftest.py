@@ -0,0 +1,4 @@
+import os
+
+# Config is read on import, so point it at the test config before anything loads it
+os.environ.setdefault("TESTING", "1")
@@ -0,0 +1,159 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+# The autoscaler imports the worker, which needs the full set of dependencies
+pytest.importorskip("redis")
+pytest.importorskip("cachetools")
+pytest.importorskip("google.cloud.texttospeech")
+
+from bot_worker import autoscaler as autoscaler_module  # noqa: E402
+from bot_worker.autoscaler import Autoscaler, CoroutinePool  # noqa: E402
+
+
+class FakePool:
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    def add(self) -> None:
+        self.size += 1
+
+    def retire(self) -> None:
+        self.size -= 1
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(autoscaler_module, "time", clock)
+    return clock
+
+
+def make_autoscaler(size: int) -> Autoscaler:
+    router = SimpleNamespace(router_id="router", depths={}, capacity=1)
+    scaler = Autoscaler(router, None, FakePool(size), 4)
+    scaler.min_size, scaler.max_size = 1, 8
+    scaler.up_depth, scaler.up_wait_ms, scaler.up_utilization = 20, 500, 0.8
+    scaler.down_depth, scaler.down_wait_ms, scaler.down_utilization = 0, 50, 0.3
+    scaler.up_cooldown, scaler.down_cooldown, scaler.down_checks = 10, 60, 3
+    return scaler
+
+
+def check(scaler: Autoscaler, depth: int = 0, busy: int = 0, wait_ms: float = 0.0) -> int:
+    """
+    Run a check against two workers of four slots and return the pool size after it
+    """
+    scaler.router.depths = {"job_queue:interactive": depth}
+    stats = [{"busy": busy / 2, "concurrency": 4, "queue_wait_ms": wait_ms}] * 2
+    scaler.check(stats)
+    return scaler.pool.size
+
+
+@pytest.mark.parametrize(
+    "load", [{"depth": 41}, {"wait_ms": 501}, {"busy": 7}], ids=["depth", "wait", "utilization"]
+)
+def test_scales_up_when_any_threshold_is_crossed(clock, load):
+    scaler = make_autoscaler(2)
+    assert check(scaler, **load) == 3
+    assert scaler.router.capacity == 12
+
+
+def test_holds_between_thresholds(clock):
+    scaler = make_autoscaler(2)
+    assert check(scaler, depth=40, busy=4, wait_ms=500) == 2
+
+
+def test_scale_up_cooldown(clock):
+    scaler = make_autoscaler(2)
+    assert check(scaler, depth=100) == 3
+    clock.now += 9
+    assert check(scaler, depth=100) == 3
+    clock.now += 1
+    assert check(scaler, depth=100) == 4
+
+
+def test_stays_within_bounds(clock):
+    assert check(make_autoscaler(0)) == 1
+    assert check(make_autoscaler(8), depth=1000) == 8
+    scaler = make_autoscaler(1)
+    for _ in range(10):
+        assert check(scaler) == 1
+
+
+def test_scales_down_only_after_enough_quiet_checks(clock):
+    scaler = make_autoscaler(3)
+    assert check(scaler) == 3
+    assert check(scaler) == 3
+    assert check(scaler) == 2
+    # Counting starts again after a change, and the cooldown applies
+    for _ in range(3):
+        clock.now += 1
+        assert check(scaler) == 2
+    clock.now += 60
+    assert check(scaler) == 1
+
+
+def test_no_scale_down_during_cooldown_after_scaling_up(clock):
+    scaler = make_autoscaler(2)
+    assert check(scaler, depth=100) == 3
+    for _ in range(5):
+        clock.now += 10
+        assert check(scaler) == 3
+    clock.now += 10
+    assert check(scaler) == 2
+
+
+def test_load_resets_quiet_checks(clock):
+    scaler = make_autoscaler(3)
+    check(scaler)
+    check(scaler)
+    assert scaler.quiet_checks == 2
+    # Over the scale down thresholds but under the scale up ones
+    assert check(scaler, busy=4) == 3
+    assert scaler.quiet_checks == 0
+    assert check(scaler) == 3
+    assert check(scaler) == 3
+    assert check(scaler) == 2
+
+
+class FakeWorker:
+    crash = True
+
+    def __init__(self, worker_id: str, db, stats_scope: str) -> None:
+        self.wid = f"worker:{worker_id}"
+        self.is_shutting_down = False
+
+    async def run(self) -> None:
+        await asyncio.sleep(0)
+        if FakeWorker.crash:
+            FakeWorker.crash = False
+            raise RuntimeError("crashed")
+        while not self.is_shutting_down:
+            await asyncio.sleep(0)
+
+
+def test_pool_replaces_crashed_workers_but_not_retired_ones(monkeypatch):
+    monkeypatch.setattr(autoscaler_module, "Worker", FakeWorker)
+
+    async def main():
+        pool = CoroutinePool(None, "router")
+        pool.add()
+        pool.add()
+        await asyncio.sleep(0.01)
+        ids = [worker.wid for worker, _ in pool.workers]
+        pool.retire()
+        await asyncio.sleep(0.01)
+        return ids, [worker.wid for worker, _ in pool.workers]
+
+    after_crash, after_retire = asyncio.run(main())
+    assert after_crash == ["worker:1", "worker:2"]
+    assert after_retire == ["worker:1"]
@@ -0,0 +1,175 @@
+import asyncio
+
+import pytest
+
+# The command table needs the full set of dependencies
+cachetools = pytest.importorskip("cachetools")
+pytest.importorskip("google.cloud.texttospeech")
+
+from bot_worker import commands  # noqa: E402
+from bot_worker.commands import PARTIAL_PUBLISHER, handle_command  # noqa: E402
+from bot_worker.metrics import COMMAND_CACHE, render  # noqa: E402
+
+COMMAND = "shared_test"
+
+
+class FakeCommand:
+    """
+    A cacheable command that counts its runs, publishes a partial result
+    then waits to be released before returning `result`
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.started = asyncio.Event()
+        self.result: tuple[int, object] = (0, "done")
+
+    async def __call__(self, text: str):
+        self.calls += 1
+        publish = PARTIAL_PUBLISHER.get()
+        if publish:
+            await publish({"partial": text})
+        self.started.set()
+        await self.release.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+@pytest.fixture
+def command(monkeypatch):
+    fake = FakeCommand()
+    monkeypatch.setitem(
+        commands.API_COMMANDS,
+        COMMAND,
+        {"func": fake, "params": ["text"], "timeout": 5, "cacheable": True, "cache_ttl": 60},
+    )
+    monkeypatch.setitem(commands.RESULT_CACHES, COMMAND, cachetools.TTLCache(10, 60))
+    monkeypatch.setitem(commands.COMMAND_STATS, COMMAND, {"hits": 0, "coalesced": 0, "misses": 0})
+    return fake
+
+
+async def call(text: str = "a", partials: list | None = None) -> dict:
+    if partials is not None:
+
+        async def publish(result: object) -> None:
+            partials.append(result)
+
+        PARTIAL_PUBLISHER.set(publish)
+    return await handle_command(COMMAND, {"text": text})
+
+
+def test_identical_concurrent_calls_run_once(command):
+    async def main():
+        callers = [asyncio.create_task(call()) for _ in range(3)]
+        other = asyncio.create_task(call("b"))
+        await command.started.wait()
+        command.release.set()
+        return await asyncio.gather(*callers), await other
+
+    results, other = asyncio.run(main())
+    assert results == [{"code": 0, "result": "done"}] * 3
+    assert other == {"code": 0, "result": "done"}
+    assert command.calls == 2
+    assert commands.COMMAND_STATS[COMMAND] == {"hits": 0, "coalesced": 2, "misses": 2}
+    assert not commands.IN_FLIGHT
+
+
+def test_results_are_cached(command):
+    hits = COMMAND_CACHE.values.get((COMMAND, "hit"), 0)
+
+    async def main():
+        command.release.set()
+        first = await call()
+        return first, await call()
+
+    first, second = asyncio.run(main())
+    assert first == second == {"code": 0, "result": "done"}
+    assert command.calls == 1
+    assert commands.COMMAND_STATS[COMMAND]["hits"] == 1
+    assert COMMAND_CACHE.values[(COMMAND, "hit")] == hits + 1
+    assert f'command_cache_total{{command="{COMMAND}",result="hit"}}' in render().decode()
+
+
+@pytest.mark.parametrize("result", [(1, "bad input"), ValueError("failed")])
+def test_errors_are_not_cached(command, result):
+    command.result = result
+
+    async def main():
+        command.release.set()
+        return await call(), await call()
+
+    first, second = asyncio.run(main())
+    assert first["code"] == second["code"] == 1
+    assert command.calls == 2
+    assert not commands.RESULT_CACHES[COMMAND]
+
+
+def test_cancelled_caller_leaves_the_shared_run_going(command):
+    async def main():
+        first = asyncio.create_task(call())
+        second = asyncio.create_task(call())
+        await command.started.wait()
+        first.cancel()
+        await asyncio.sleep(0)
+        command.release.set()
+        return first, await second
+
+    first, second = asyncio.run(main())
+    assert first.cancelled()
+    assert second == {"code": 0, "result": "done"}
+    assert command.calls == 1
+
+
+def test_late_joiners_get_partials_replayed(command):
+    early, late = [], []
+
+    async def main():
+        first = asyncio.create_task(call(partials=early))
+        await command.started.wait()
+        second = asyncio.create_task(call(partials=late))
+        await asyncio.sleep(0)
+        command.release.set()
+        return await asyncio.gather(first, second)
+
+    results = asyncio.run(main())
+    assert results == [{"code": 0, "result": "done"}] * 2
+    assert early == late == [{"partial": "a"}]
+    assert command.calls == 1
+
+
+@pytest.mark.parametrize("early", [False, True])
+def test_say_test_returns_the_full_clip(monkeypatch, early):
+    written = {}
+
+    async def get_speech(text: str) -> bytes:
+        return text.encode()
+
+    async def write_output(audio: bytes) -> str:
+        path = f"out/{len(written)}.mp3"
+        written[path] = audio
+        return path
+
+    monkeypatch.setattr(commands.GoogleHandler, "get_speech", get_speech)
+    monkeypatch.setattr(commands.GoogleHandler, "write_output", write_output)
+    monkeypatch.setitem(commands.CONFIG["texttospeech"], "chunk_chars", "12")
+    monkeypatch.setitem(commands.CONFIG["texttospeech"], "early_first_chunk", str(early))
+    partials = []
+
+    async def main():
+        async def publish(result: object) -> None:
+            partials.append(result)
+
+        PARTIAL_PUBLISHER.set(publish)
+        return await commands.say_test("One two. Three four. Five.")
+
+    code, result = asyncio.run(main())
+    assert code == 0
+    assert written[result["path"]] == b"One two.Three four.Five."
+    if early:
+        assert [written[partial["path"]] for partial in partials] == [b"One two."]
+        assert written[result["rest_path"]] == b"Three four.Five."
+    else:
+        assert not partials
+        assert "rest_path" not in result
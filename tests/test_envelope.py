@@ -0,0 +1,97 @@
+import struct
+
+import pytest
+
+from bot_worker.envelope import (
+    FLAG_PARTIAL,
+    FLAG_TRACED,
+    VERSION,
+    Envelope,
+    new_job_id,
+    origin_of,
+    pack,
+    unpack,
+)
+from bot_worker.exceptions import MessageInvalidError
+
+FRAMES = [b"client", b"", b'{"command": "ping"}']
+
+
+def pack_old(header: bytes, job_id: str, frames: list[bytes]) -> bytes:
+    """
+    Body of an older envelope after its header, which is laid out the same as the current one
+    """
+    parts = [header, struct.pack("!B", len(job_id)), job_id.encode()]
+    for frame in frames:
+        parts += [struct.pack("!I", len(frame)), frame]
+    return b"".join(parts)
+
+
+def test_roundtrip():
+    envelope = Envelope("r:1", FRAMES, FLAG_PARTIAL)
+    decoded = unpack(pack(envelope))
+    assert decoded == envelope
+    assert decoded.routing == FRAMES[:-1]
+    assert decoded.payload == FRAMES[-1]
+    assert decoded.is_partial
+
+
+def test_roundtrip_with_times():
+    envelope = Envelope("r:1", FRAMES, 0, 10.5, 9.5, 0.25)
+    assert unpack(pack(envelope)) == envelope
+
+
+def test_roundtrip_with_trace():
+    trace = [["recv", 1.5, 100, "router"], ["start", 2.5, 101, "worker:0"]]
+    decoded = unpack(pack(Envelope("r:1", FRAMES, trace=trace)))
+    assert decoded.trace == trace
+    assert decoded.flags == FLAG_TRACED
+
+
+def test_traced_flag_follows_the_trace():
+    decoded = unpack(pack(Envelope("r:1", FRAMES, FLAG_TRACED)))
+    assert decoded.trace is None
+    assert decoded.flags == 0
+
+
+def test_expiry():
+    envelope = Envelope("r:1", FRAMES, deadline=10.0)
+    assert not envelope.is_expired(9.0)
+    assert envelope.is_expired(11.0)
+    assert not Envelope("r:1", FRAMES).is_expired(11.0)
+
+
+def test_decodes_v2():
+    data = pack_old(struct.pack("!BBBdd", 2, FLAG_PARTIAL, 3, 10.5, 9.5), "r:1", FRAMES)
+    assert unpack(data) == Envelope("r:1", FRAMES, FLAG_PARTIAL, 10.5, 9.5)
+
+
+def test_header_extends_v2():
+    data = pack(Envelope("r:1", FRAMES, 0, 10.5, 9.5, 0.25))
+    assert data[0] == VERSION
+    assert struct.unpack_from("!BBBdd", data) == (VERSION, 0, 3, 10.5, 9.5)
+
+
+def test_decodes_v1():
+    data = pack_old(struct.pack("!BBB", 1, 0, 3), "r:1", FRAMES)
+    assert unpack(data) == Envelope("r:1", FRAMES)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"\x09" + pack(Envelope("r:1", FRAMES))[1:],
+        pack(Envelope("r:1", FRAMES))[:-1],
+        pack(Envelope("r:1", FRAMES)) + b"\x00",
+        pack(Envelope("r:1", [])),
+    ],
+    ids=["empty", "unknown version", "truncated", "trailing bytes", "no frames"],
+)
+def test_rejects_malformed(data):
+    with pytest.raises(MessageInvalidError):
+        unpack(data)
+
+
+def test_job_id_origin():
+    assert origin_of(new_job_id("router:host:1")) == "router:host:1"
@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip("google.cloud.texttospeech")
+
+from bot_worker.google_handler import GoogleHandler  # noqa: E402
+
+split_text = GoogleHandler.split_text
+
+
+def test_short_text_is_one_chunk():
+    assert split_text("  Hello there.  ", 100) == ["Hello there."]
+
+
+def test_splits_on_sentences():
+    text = "First sentence. Second one! Third?"
+    assert split_text(text, 20) == ["First sentence.", "Second one! Third?"]
+
+
+def test_long_sentence_splits_on_words():
+    chunks = split_text("one two three four five six seven", 10)
+    assert chunks == ["one two", "three four", "five six", "seven"]
+    assert all(len(chunk) <= 10 for chunk in chunks)
+
+
+def test_chunks_rejoin_to_the_text():
+    text = "A fairly long opening sentence goes here. Then a short one. " * 5
+    chunks = split_text(text, 50)
+    assert all(len(chunk) <= 50 for chunk in chunks)
+    assert " ".join(chunks) == text.strip()
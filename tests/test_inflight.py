@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+from bot_worker.inflight import TimerWheel
+
+
+def make_wheel(slots: int = 4, levels: int = 2) -> TimerWheel:
+    wheel = TimerWheel(1.0, slots, levels)
+    wheel.start = 0.0
+    return wheel
+
+
+def run_until(wheel: TimerWheel, end: int) -> dict[str, int]:
+    """
+    Advance a tick at a time, returning the tick each key expired on
+    """
+    expired = {}
+    for tick in range(wheel.current + 1, end + 1):
+        for key in wheel.advance(tick):
+            expired[key] = tick
+    return expired
+
+
+def test_expires_on_the_tick_after_the_deadline():
+    wheel = make_wheel()
+    wheel.schedule("job", 2.5)
+    assert wheel.advance(2.9) == []
+    assert wheel.advance(3.0) == ["job"]
+    assert len(wheel) == 0
+
+
+@pytest.mark.parametrize("deadline", [1, 3, 4, 5, 15, 16, 17, 31, 64, 100])
+def test_expires_across_level_boundaries_and_past_the_top_level(deadline):
+    # 4 slots over 2 levels only covers 16 ticks, so later timers are parked and re-placed
+    wheel = make_wheel()
+    wheel.schedule("job", deadline)
+    assert run_until(wheel, deadline + 5) == {"job": deadline + 1}
+
+
+def test_many_timers_scheduled_as_the_wheel_turns():
+    rng = random.Random(1)
+    wheel = make_wheel()
+    due, expired = {}, {}
+    for tick in range(1, 200):
+        expired.update(run_until(wheel, tick))
+        key = f"job{tick}"
+        due[key] = tick + rng.randint(0, 80)
+        wheel.schedule(key, due[key])
+    expired.update(run_until(wheel, 300))
+    assert expired == {key: deadline + 1 for key, deadline in due.items()}
+
+
+def test_cancel_after_cascade():
+    wheel = make_wheel()
+    wheel.schedule("job", 10)
+    wheel.schedule("other", 10)
+    # Past the level boundary at tick 8, so both have cascaded into level 0
+    assert run_until(wheel, 9) == {}
+    assert wheel.timers["job"][1] == 0
+    wheel.cancel("job")
+    assert run_until(wheel, 20) == {"other": 11}
+    assert len(wheel) == 0
+
+
+def test_cancel_parked_timer():
+    wheel = make_wheel()
+    wheel.schedule("job", 50)
+    run_until(wheel, 20)
+    wheel.cancel("job")
+    assert run_until(wheel, 60) == {}
+
+
+def test_reschedule_replaces_the_timer():
+    wheel = make_wheel()
+    wheel.schedule("job", 3)
+    wheel.schedule("job", 20)
+    assert run_until(wheel, 25) == {"job": 21}
+
+
+def test_deadline_in_the_past_expires_on_the_next_tick():
+    wheel = make_wheel()
+    run_until(wheel, 10)
+    wheel.schedule("job", 2)
+    assert wheel.advance(11) == ["job"]
@@ -0,0 +1,44 @@
+from collections import Counter
+
+import pytest
+
+# lanes reads the command table, which needs the full set of dependencies
+pytest.importorskip("cachetools")
+pytest.importorskip("google.cloud.texttospeech")
+
+from bot_worker.lanes import (  # noqa: E402
+    DEFAULT_LANE,
+    LaneScheduler,
+    command_of,
+    lane_for,
+)
+
+
+def test_lanes_are_picked_first_in_proportion_to_weight():
+    scheduler = LaneScheduler({"interactive": 4, "heavy": 1})
+    firsts = Counter(scheduler.order()[0] for _ in range(50))
+    assert firsts == {"interactive": 40, "heavy": 10}
+
+
+def test_picks_are_spread_out():
+    scheduler = LaneScheduler({"interactive": 2, "heavy": 1})
+    firsts = [scheduler.order()[0] for _ in range(6)]
+    assert firsts == ["interactive", "heavy", "interactive"] * 2
+
+
+def test_every_lane_is_in_each_order():
+    scheduler = LaneScheduler({"a": 5, "b": 3, "c": 1})
+    for _ in range(20):
+        assert sorted(scheduler.order()) == ["a", "b", "c"]
+
+
+def test_command_of():
+    assert command_of(b'{"command": "memeoftheday"}') == "memeoftheday"
+    assert command_of(b'{"command": "unknown"}') == ""
+    assert command_of(b"not json") == ""
+    assert command_of(b"[]") == ""
+
+
+def test_lane_for():
+    assert lane_for("memeoftheday") == "heavy"
+    assert lane_for("unknown") == DEFAULT_LANE
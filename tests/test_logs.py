@@ -0,0 +1,55 @@
+import logging
+import queue
+import threading
+from logging.handlers import RotatingFileHandler
+
+import pytest
+
+from bot_worker.logs import DroppingQueueHandler, LogWriter, parse_level
+
+
+class RecordingHandler(RotatingFileHandler):
+    """
+    Notes the threads records are formatted on
+    """
+
+    threads: set[str] = set()
+
+    def format(self, record: logging.LogRecord) -> str:
+        self.threads.add(threading.current_thread().name)
+        return super().format(record)
+
+
+def test_parse_level():
+    assert parse_level("info", "[logging] level") == logging.INFO
+    assert parse_level("Warning", "[logging] level") == logging.WARNING
+    with pytest.raises(ValueError, match=r"\[log_levels\] router: verbose"):
+        parse_level("verbose", "[log_levels] router")
+
+
+def test_writer_writes_and_rotates_off_the_calling_thread(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    target = RecordingHandler(path, maxBytes=100, backupCount=5)
+    handler = DroppingQueueHandler(queue.Queue(100))
+    writer = LogWriter(target, handler)
+    writer.start()
+    for i in range(10):
+        handler.handle(logging.makeLogRecord({"msg": str(i) * 20}))
+    writer.stop()
+
+    assert target.threads == {"log-writer"}
+    files = sorted(tmp_path.iterdir())
+    assert len(files) > 1
+    lines = [line for file in files for line in file.read_text().splitlines()]
+    assert sorted(lines) == [str(i) * 20 for i in range(10)]
+
+
+def test_full_queue_drops_records(tmp_path):
+    handler = DroppingQueueHandler(queue.Queue(2))
+    for i in range(5):
+        handler.handle(logging.makeLogRecord({"msg": str(i)}))
+    assert handler.dropped == 3
+    writer = LogWriter(logging.FileHandler(tmp_path / "log"), handler)
+    writer.start()
+    writer.stop()
+    assert (tmp_path / "log").read_text().splitlines()[-1].endswith("Dropped 3 log records")
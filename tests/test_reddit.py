@@ -0,0 +1,33 @@
+import asyncio
+import logging
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from bot_worker.reddit import MemePool  # noqa: E402
+from bot_worker.sampling import MemeIndex  # noqa: E402
+
+
+def test_failed_background_refresh_is_logged(monkeypatch, caplog):
+    async def refresh():
+        raise RuntimeError("reddit is down")
+
+    index = MemeIndex(exclude_recent=0)
+    index.update([{"id": "a", "url": "https://i.redd.it/a.jpg", "score": 1}])
+    monkeypatch.setattr(MemePool, "index", index)
+    monkeypatch.setattr(MemePool, "refreshed_at", 0.0)
+    monkeypatch.setattr(MemePool, "refresh_task", None)
+    monkeypatch.setattr(MemePool, "_refresh", refresh)
+
+    async def main():
+        # Stale, so served while a refresh runs in the background
+        meme = await MemePool.sample()
+        await asyncio.sleep(0)
+        return meme
+
+    with caplog.at_level(logging.ERROR):
+        assert asyncio.run(main())["id"] == "a"
+    [record] = caplog.records
+    assert record.getMessage() == "[reddit] Failed to refresh meme pool"
+    assert str(record.exc_info[1]) == "reddit is down"
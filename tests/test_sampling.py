@@ -0,0 +1,101 @@
+import random
+from collections import Counter
+
+from bot_worker.sampling import MemeIndex
+
+
+def post(post_id: str, score: int) -> dict:
+    return {"id": post_id, "url": f"https://i.redd.it/{post_id}.jpg", "score": score}
+
+
+def test_sampling_is_weighted_by_score():
+    random.seed(1)
+    index = MemeIndex(exclude_recent=0)
+    index.update([post("a", 100), post("b", 300), post("c", 600)])
+    counts = Counter(index.sample()["id"] for _ in range(10000))
+    assert 0.08 < counts["a"] / 10000 < 0.12
+    assert 0.27 < counts["b"] / 10000 < 0.33
+    assert 0.57 < counts["c"] / 10000 < 0.63
+
+
+def test_scores_below_one_still_get_sampled():
+    index = MemeIndex(exclude_recent=0)
+    index.update([post("a", -50)])
+    assert index.sample()["id"] == "a"
+
+
+def test_deduplicates_by_id_and_url():
+    index = MemeIndex(exclude_recent=0)
+    crosspost = {**post("b", 10), "url": post("a", 0)["url"]}
+    index.update([post("a", 10), post("a", 20), crosspost])
+    assert len(index) == 1
+    # The first copy in a scrape wins
+    assert index.sample() == post("a", 10)
+
+
+def test_recent_picks_are_excluded():
+    random.seed(1)
+    index = MemeIndex(exclude_recent=2)
+    index.update([post(str(i), 10) for i in range(3)])
+    picks = [index.sample()["id"] for _ in range(30)]
+    for window in zip(picks, picks[1:], picks[2:]):
+        assert len(set(window)) == 3
+
+
+def test_empty_index():
+    assert MemeIndex(exclude_recent=5).sample() is None
+
+
+def test_tombstoned_posts_are_never_sampled():
+    random.seed(1)
+    index = MemeIndex(exclude_recent=0)
+    posts = [post(str(i), 10) for i in range(10)]
+    index.update(posts)
+    index.update(posts[:8])
+    assert len(index) == 8
+    assert len(index.posts) == 10
+    assert {index.sample()["id"] for _ in range(500)} == {str(i) for i in range(8)}
+
+
+def test_tombstoned_post_comes_back():
+    index = MemeIndex(exclude_recent=0)
+    posts = [post(str(i), 10) for i in range(10)]
+    index.update(posts)
+    index.update(posts[1:])
+    assert index.removed_weight == 10
+    index.update(posts)
+    assert len(index) == 10
+    assert not index.removed
+    assert index.removed_weight == 0
+
+
+def test_compacts_once_most_posts_are_tombstoned():
+    random.seed(1)
+    index = MemeIndex(exclude_recent=0)
+    posts = [post(str(i), 10) for i in range(10)]
+    index.update(posts)
+    index.update(posts[:4])
+    assert len(index.posts) == 4
+    assert not index.removed
+    assert {index.sample()["id"] for _ in range(200)} == {"0", "1", "2", "3"}
+
+
+def test_compacts_once_much_of_the_weight_is_tombstoned():
+    index = MemeIndex(exclude_recent=0)
+    posts = [post("top", 1000)] + [post(str(i), 10) for i in range(9)]
+    index.update(posts)
+    index.update(posts[1:])
+    assert len(index.posts) == 9
+    assert index.total == 90
+
+
+def test_compaction_keeps_recent_picks_excluded():
+    random.seed(1)
+    index = MemeIndex(exclude_recent=1)
+    posts = [post(str(i), 10) for i in range(10)]
+    index.update(posts)
+    last = index.sample()["id"]
+    index.update([p for p in posts if p["id"] == last] + [p for p in posts if p["id"] != last][:2])
+    assert len(index.posts) == 3
+    assert [index.posts[pos]["id"] for pos in index.recent] == [last]
+    assert index.sample()["id"] != last